@@ -18,22 +18,198 @@ import os
 import gevent
 import gevent.event
 import gevent.pool
+import gevent.threadpool
 import zmq.green as zmq
 import traceback
 import time
 from beach.utils import *
 from beach.utils import _TimeoutException
+from beach.utils import _sanitizeJson
 from beach.utils import _ZMREQ
 from beach.utils import _ZMREP
+from beach.utils import _ZMROUTER
 from beach.utils import _ZSocket
+from beach.utils import _DirectoryMirror
+from beach.utils import _ModuleCache
+from beach.utils import _ResultCache
+import sys
 import random
 import logging
 import imp
 import hashlib
-import inspect
+import json
+import signal
+import socket
+import struct
+import multiprocessing
+import gevent.queue
+import gevent.socket
+import gevent.local
+import uuid
+
+class _RequestCancelled ( gevent.GreenletExit ):
+    '''Raised in a handler when the caller cancelled the request it is serving.'''
+    pass
+
+# The deadline of the request the current handler greenlet is serving, requests
+# it makes to other actors can't be given more time than what it has left.
+_requestContext = gevent.local.local()
+
+def _getRemainingTime():
+    deadline = getattr( _requestContext, 'deadline', None )
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+class _ProcessPool ( object ):
+    # Worker processes forked from an actor once it is initialized, so they have
+    # its state and handlers. Requests and replies go over a socket pair to each
+    # worker as length prefixed json.
+    _FRAME = struct.Struct( '!I' )
+
+    def __init__( self, actor, size ):
+        self._actor = actor
+        self._workers = []
+        self._idle = gevent.queue.Queue()
+        for n in range( size ):
+            self._idle.put( self._startWorker() )
+
+    def _startWorker( self ):
+        parentSock, childSock = socket.socketpair()
+        pid = os.fork()
+        if 0 == pid:
+            parentSock.close()
+            # Holding the sockets of the other workers would keep them from
+            # seeing their socket close when the pool stops
+            for otherPid, otherSock in self._workers:
+                otherSock.close()
+            exitCode = 0
+            try:
+                self._work( childSock )
+            except:
+                exitCode = 1
+            os._exit( exitCode )
+        childSock.close()
+        worker = ( pid, gevent.socket.socket( _sock = parentSock ) )
+        self._workers.append( worker )
+        return worker
+
+    @classmethod
+    def _sendFrame( cls, sock, data ):
+        payload = json.dumps( _sanitizeJson( data ) )
+        sock.sendall( cls._FRAME.pack( len( payload ) ) + payload )
+
+    @classmethod
+    def _recvFrame( cls, sock ):
+        header = cls._recvExactly( sock, cls._FRAME.size )
+        if header is None:
+            return None
+        payload = cls._recvExactly( sock, cls._FRAME.unpack( header )[ 0 ] )
+        if payload is None:
+            return None
+        return json.loads( payload )
+
+    @classmethod
+    def _recvExactly( cls, sock, size ):
+        data = ''
+        while len( data ) < size:
+            chunk = sock.recv( size - len( data ) )
+            if '' == chunk:
+                return None
+            data += chunk
+        return data
+
+    def _work( self, sock ):
+        # We're a plain process now, the parent takes care of the signals
+        signal.signal( signal.SIGQUIT, signal.SIG_DFL )
+        signal.signal( signal.SIGINT, signal.SIG_IGN )
+        while True:
+            req = self._recvFrame( sock )
+            if req is None:
+                break
+            handler = self._actor._handlers.get( req[ 'req' ], self._actor._defaultHandler )
+            try:
+                ret = handler( req[ 'msg' ] )
+            except:
+                ret = errorMessage( 'exception', { 'st' : traceback.format_exc() } )
+            # Same conventions as the handlers running in the actor
+            if ret is True:
+                ret = successMessage()
+            elif type( ret ) is str or type( ret ) is unicode:
+                ret = errorMessage( ret )
+            try:
+                payload = _sanitizeJson( ret )
+            except AttributeError:
+                payload = errorMessage( 'invalid reply from handler' )
+            self._sendFrame( sock, payload )
+
+    def apply( self, action, msg ):
+        '''Returns the ( reply, seconds waited for a worker ) of the request.'''
+        queuedAt = time.time()
+        worker = self._idle.get()
+        queueTime = time.time() - queuedAt
+        try:
+            self._sendFrame( worker[ 1 ], { 'req' : action, 'msg' : msg } )
+            ret = self._recvFrame( worker[ 1 ] )
+        except socket.error:
+            ret = None
+        except gevent.GreenletExit:
+            # The request was cancelled, the worker is stopped with it so its
+            # reply doesn't get mistaken for the next request's.
+            self._stopWorker( worker, isForced = True )
+            self._idle.put( self._startWorker() )
+            raise
+        if ret is None:
+            # The worker died with the request, it gets replaced by a new one
+            self._stopWorker( worker )
+            worker = self._startWorker()
+            ret = errorMessage( 'worker process died' )
+        self._idle.put( worker )
+        return ( ret, queueTime )
+
+    def _stopWorker( self, worker, isForced = False ):
+        pid, sock = worker
+        sock.close()
+        self._workers.remove( worker )
+        for n in range( 0 if isForced else 20 ):
+            if 0 != os.waitpid( pid, os.WNOHANG )[ 0 ]:
+                return
+            gevent.sleep( 0.1 )
+        try:
+            os.kill( pid, signal.SIGKILL )
+            os.waitpid( pid, 0 )
+        except OSError:
+            pass
+
+    def close( self ):
+        # Closing their socket is what tells the workers to exit, they all get
+        # told before we wait for any of them
+        for pid, sock in self._workers:
+            sock.close()
+        for worker in list( self._workers ):
+            self._stopWorker( worker )
 
 class Actor( gevent.Greenlet ):
 
+    _moduleCache = _ModuleCache()
+    _threadPool = None
+    _threadPoolSize = 10
+
+    @classmethod
+    def _setModuleCache( cls, moduleCache ):
+        cls._moduleCache = moduleCache
+
+    @classmethod
+    def _setThreadPoolSize( cls, size ):
+        cls._threadPoolSize = size
+
+    @classmethod
+    def _getThreadPool( cls ):
+        # One pool per instance, shared by all its actors, created on first use
+        if Actor._threadPool is None:
+            Actor._threadPool = gevent.threadpool.ThreadPool( cls._threadPoolSize )
+        return Actor._threadPool
+
     @classmethod
     def importLib( cls, libName, className = None ):
         '''Import a user-defined lib from the proper realm.
@@ -46,10 +222,8 @@ class Actor( gevent.Greenlet ):
         :returns: the module or element of the module loaded
         '''
 
-        fileName = '%s/%s.py' % ( os.path.dirname( os.path.abspath( inspect.stack()[ 1 ][ 1 ] ) ), libName )
-        with open( fileName, 'r' ) as hFile:
-            fileHash = hashlib.sha1( hFile.read() ).hexdigest()
-        mod = imp.load_source( '%s_%s' % ( libName, fileHash ), fileName )
+        fileName = '%s/%s.py' % ( os.path.dirname( os.path.abspath( sys._getframe( 1 ).f_code.co_filename ) ), libName )
+        mod = cls._moduleCache.load( fileName, libName )
 
         if className is not None:
             mod = getattr( mod, className )
@@ -72,13 +246,58 @@ class Actor( gevent.Greenlet ):
 
         # We keep track of all the handlers for the user per message request type
         self._handlers = {}
+        self._offloads = {}
+        self._offloadStats = {}
+        self._requestLanes = {}
+        self._limits = {}
+        self._cacheTtls = {}
 
         # All user generated threads
         self._threads = gevent.pool.Group()
 
-        # This socket receives all taskings for the actor and dispatch
-        # the messages as requested by user
-        self._opsSocket = _ZMREP( 'tcp://%s:%d' % ( self._ip, self._port ), isBind = True )
+        # This socket receives all taskings for the actor and queues them
+        # for the handlers to dispatch as requested by user
+        hostConfig = getattr( self._host, 'configFile', None ) or {}
+        # When its mailbox is full the actor replies 'busy' right away so callers can
+        # go to another actor instead of timing out.
+        self._opsSocket = _ZMROUTER( 'tcp://%s:%d' % ( self._ip, self._port ),
+                                     isBind = True,
+                                     queueSize = hostConfig.get( 'actor_queue_size', 1000 ),
+                                     onFull = self._busyReply if hostConfig.get( 'actor_shed_load', True ) else None,
+                                     immediate = { '__cancel' : self._cancelRequest },
+                                     laneOf = self._getLane )
+        self._nHandlers = 0
+        self._targetHandlers = 0
+        self._nBusy = 0
+        self._processPool = None
+
+        # Lanes set with SetLane(), each with its weight and handlers dedicated to it.
+        self._lanes = {}
+        self._processLane = '__process'
+        self._processPoolSize = hostConfig.get( 'handler_process_pool_size', 1 ) or multiprocessing.cpu_count()
+
+        # Stats of the requests handled, the interval ones are reset by the
+        # adaptive concurrency controller every time it runs.
+        self._nProcessed = 0
+        self._nExpired = 0
+        self._nCancelled = 0
+
+        # Handler greenlets per request id being served, and the ids of requests
+        # cancelled before we got to them.
+        self._running = {}
+        self._cancelled = {}
+        self._intervalStats = self._newIntervalStats()
+        self._avgLatency = None
+        self._lastLatency = None
+        self._lastQueueDelay = None
+        self._baseLatency = None
+        self._concurrencyLimits = None
+        if hostConfig.get( 'actor_adaptive_concurrency', False ):
+            self._concurrencyLimits = ( hostConfig.get( 'actor_concurrency_min', 1 ),
+                                        hostConfig.get( 'actor_concurrency_max', 32 ) )
+
+        # Results of the handlers registered with a cacheTtl, capped in bytes per actor
+        self._resultCache = _ResultCache( hostConfig.get( 'actor_cache_max_bytes', 16 * 1024 * 1024 ) )
 
         self._vHandles = []
 
@@ -92,6 +311,13 @@ class Actor( gevent.Greenlet ):
         # Actor.AddConcurrentHandler()
         self.AddConcurrentHandler()
 
+        if 'process' in self._offloads.values():
+            # Forked now so the workers get everything init() loaded
+            self._processPool = _ProcessPool( self, self._processPoolSize )
+
+        if self._concurrencyLimits is not None:
+            self.SetAdaptiveConcurrency( *self._concurrencyLimits )
+
         self.stopEvent.wait()
 
         self._opsSocket.close()
@@ -108,36 +334,357 @@ class Actor( gevent.Greenlet ):
         for v in self._vHandles:
             v.close()
 
+        if self._processPool is not None:
+            self._processPool.close()
+
         if hasattr( self, 'deinit' ):
             self.deinit()
 
     def AddConcurrentHandler( self ):
         '''Add a new thread handling requests to the actor.'''
-        self._threads.add( gevent.spawn( self._opsHandler ) )
-
-    def _opsHandler( self ):
-        z = self._opsSocket.getChild()
-        while not self.stopEvent.wait( 0 ):
-            msg = z.recv()
-            if msg is not None and 'req' in msg and not self.stopEvent.wait( 0 ):
-                action = msg[ 'req' ]
-                self.log( "Received: %s" % action )
-                handler = self._handlers.get( action, self._defaultHandler )
+        self.SetConcurrentHandlers( self._targetHandlers + 1 )
+
+    def SetConcurrentHandlers( self, nHandlers ):
+        '''Set the number of threads handling requests to the actor.
+
+        :param nHandlers: the number of requests handled concurrently, extra threads
+            exit after the request they are handling
+        '''
+        self._targetHandlers = max( nHandlers, 1 )
+        for n in range( self._targetHandlers - self._nHandlers ):
+            self._nHandlers += 1
+            self._threads.add( gevent.spawn( self._opsHandler ) )
+
+    def SetAdaptiveConcurrency( self, minHandlers = 1, maxHandlers = 32, interval = 1 ):
+        '''Let the number of threads handling requests adapt to the load, it grows
+            by one while the latency of requests stays flat and requests wait for a
+            handler, and shrinks by a quarter when the latency rises. The time spent
+            waiting in the mailbox is not a reason to back off: it grows when requests
+            come in faster than the handlers serve them, which more handlers fix, while
+            a latency rise means the handlers slow each other down.
+
+        :param minHandlers: the minimum number of requests handled concurrently
+        :param maxHandlers: the maximum number of requests handled concurrently
+        :param interval: the number of seconds between adjustments
+        '''
+        isRunning = hasattr( self, '_concurrencyThread' )
+        self._concurrencyLimits = ( max( minHandlers, 1 ), max( maxHandlers, minHandlers, 1 ) )
+        self._concurrencyInterval = interval
+        self.SetConcurrentHandlers( min( max( self._targetHandlers, self._concurrencyLimits[ 0 ] ),
+                                         self._concurrencyLimits[ 1 ] ) )
+        if not isRunning:
+            self._concurrencyThread = gevent.spawn( self._svc_adaptConcurrency )
+            self._threads.add( self._concurrencyThread )
+
+    def SetLane( self, lane, weight = 1, minHandlers = 0, isExclusive = False ):
+        '''Set how the requests of a lane (see handle()) get served. Each lane has
+            its own queue and when requests are waiting in several of them, they
+            are served in proportion of the lane weights.
+
+        :param lane: the name of the lane
+        :param weight: the share of the handlers the lane gets relative to the others,
+            the requests not in a lane have a weight of 1
+        :param minHandlers: the number of threads only handling requests of this lane,
+            on top of the ones set by SetConcurrentHandlers(), so the lane keeps being
+            served when all the others are busy
+        :param isExclusive: if True, only the threads of this lane handle its requests
+        '''
+        if lane is None:
+            raise ValueError( 'the default lane cannot be set' )
+        info = self._lanes.setdefault( lane, { 'weight' : 1, 'min_handlers' : 0, 'handlers' : 0 } )
+        info[ 'weight' ] = weight
+        info[ 'min_handlers' ] = max( minHandlers, 0 )
+        self._opsSocket.setLaneWeight( lane, weight )
+        self._opsSocket.setLaneExclusive( lane, isExclusive )
+        for n in range( info[ 'min_handlers' ] - info[ 'handlers' ] ):
+            info[ 'handlers' ] += 1
+            self._threads.add( gevent.spawn( self._opsHandler, lane ) )
+
+    def _getLane( self, msg ):
+        # Request types waiting for their concurrency limit get a queue of their own
+        # in their lane, it is paused while they are at the limit.
+        if type( msg ) is not dict:
+            return None
+        try:
+            lane = self._requestLanes.get( msg.get( 'req', None ), None )
+            limit = self._limits.get( msg.get( 'req', None ), None )
+        except TypeError:
+            return None
+        if limit is not None and 'wait' == limit[ 'over_limit' ]:
+            return ( lane, msg[ 'req' ] )
+        return lane
+
+    def _enterLimit( self, action, limit ):
+        limit[ 'running' ] += 1
+        if 'wait' == limit[ 'over_limit' ] and limit[ 'running' ] >= limit[ 'max_concurrent' ]:
+            self._opsSocket.pause( ( self._requestLanes.get( action, None ), action ) )
+
+    def _exitLimit( self, action, limit ):
+        limit[ 'running' ] -= 1
+        if limit[ 'running' ] < limit[ 'max_concurrent' ]:
+            self._opsSocket.resume( ( self._requestLanes.get( action, None ), action ) )
+
+    def _getNDedicatedHandlers( self ):
+        return sum( x[ 'min_handlers' ] for x in self._lanes.itervalues() )
+
+    def _isExtraHandler( self, lane ):
+        if lane is None:
+            return self._nHandlers > self._targetHandlers
+        info = self._lanes[ lane ]
+        return info[ 'handlers' ] > info[ 'min_handlers' ]
+
+    def _newIntervalStats( self ):
+        return { 'processed' : 0, 'latency' : 0.0, 'queue_delay' : 0.0, 'max_busy' : 0 }
+
+    def _svc_adaptConcurrency( self ):
+        while not self.stopEvent.wait( self._concurrencyInterval ):
+            stats = self._intervalStats
+            self._intervalStats = self._newIntervalStats()
+            if 0 == stats[ 'processed' ]:
+                continue
+            latency = stats[ 'latency' ] / stats[ 'processed' ]
+            self._lastLatency = latency
+            self._lastQueueDelay = stats[ 'queue_delay' ] / stats[ 'processed' ]
+
+            # The no-load latency is the lowest we've seen, it slowly drifts up so
+            # it follows changes in the kind of requests we get.
+            if self._baseLatency is None or latency < self._baseLatency:
+                self._baseLatency = latency
+            else:
+                self._baseLatency += ( latency - self._baseLatency ) * 0.01
+
+            minHandlers, maxHandlers = self._concurrencyLimits
+            if latency > self._baseLatency * 2:
+                # Requests are queueing somewhere inside the handlers, back off
+                self.SetConcurrentHandlers( max( minHandlers, int( self._targetHandlers * 0.75 ) ) )
+            elif ( stats[ 'max_busy' ] >= self._targetHandlers + self._getNDedicatedHandlers() or
+                   0 != self._opsSocket.getQueueDepth() or
+                   self._lastQueueDelay > latency ):
+                # Requests wait for a handler longer than it takes to serve them
+                self.SetConcurrentHandlers( min( maxHandlers, self._targetHandlers + 1 ) )
+
+    def getMetrics( self ):
+        '''Get the metrics of the requests handled by the actor.
+
+        :returns: a dict with the current number of handlers, how many of them are
+            busy, the number of requests waiting, processed, dropped because their
+            deadline had passed and cancelled, the adaptive concurrency limits,
+            the average latency and queueing delay of requests in seconds and the
+            number of offloaded requests and their time waiting for the pool,
+            per lane the requests waiting, its weight and dedicated handlers, and per
+            request type with a concurrency limit the limit, the requests running,
+            waiting and rejected, and the hits, misses and size of the result cache
+        '''
+        return { 'handlers' : self._targetHandlers,
+                 'busy' : self._nBusy,
+                 'queue_depth' : self._opsSocket.getQueueDepth(),
+                 'processed' : self._nProcessed,
+                 'expired' : self._nExpired,
+                 'cancelled' : self._nCancelled,
+                 'adaptive' : self._concurrencyLimits,
+                 'latency' : self._lastLatency,
+                 'base_latency' : self._baseLatency,
+                 'queue_delay' : self._lastQueueDelay,
+                 'offload' : self._offloadStats,
+                 'lanes' : dict( ( lane, { 'queue_depth' : self._opsSocket.getQueueDepth( lane ),
+                                           'weight' : info[ 'weight' ],
+                                           'min_handlers' : info[ 'min_handlers' ] } )
+                                 for lane, info in self._lanes.iteritems() ),
+                 'limits' : dict( ( requestType, { 'max_concurrent' : limit[ 'max_concurrent' ],
+                                                   'running' : limit[ 'running' ],
+                                                   'queue_depth' : self._opsSocket.getQueueDepth( ( self._requestLanes.get( requestType, None ), requestType ) ),
+                                                   'rejected' : limit[ 'rejected' ] } )
+                                  for requestType, limit in self._limits.iteritems() ),
+                 'cache' : self._resultCache.getMetrics() }
+
+    def _opsHandler( self, lane = None ):
+        try:
+            while not self.stopEvent.wait( 0 ):
+                # Checked and counted without yielding so only the extra handlers exit
+                if self._isExtraHandler( lane ):
+                    break
+                req = self._opsSocket.getRequest( timeout = 1, lane = lane )
+                # Nothing may yield from here until the request is counted against its limit
+                if req is None or self.stopEvent.is_set():
+                    continue
+                envelope, msg, receivedAt = req
+                start = time.time()
+                deadline, rid = self._getRequestMetadata( msg )
+                if deadline is not None and deadline < start:
+                    # The caller already gave up on this one, don't waste time on it
+                    self._nExpired += 1
+                    self._opsSocket.reply( envelope, errorMessage( 'deadline expired' ) )
+                    continue
+                if rid is not None and self._cancelled.pop( rid, None ) is not None:
+                    self._nCancelled += 1
+                    self._opsSocket.reply( envelope, errorMessage( 'cancelled' ) )
+                    continue
                 try:
-                    ret = handler( msg )
-                except gevent.GreenletExit:
-                    raise
-                except:
-                    ret = errorMessage( 'exception', { 'st' : traceback.format_exc() } )
-                if ret is True:
-                    ret = successMessage()
-                elif type( ret ) is str or type( ret ) is unicode:
-                    ret = errorMessage( ret )
-                z.send( ret )
+                    limit = self._limits.get( msg.get( 'req', None ), None ) if type( msg ) is dict else None
+                except TypeError:
+                    limit = None
+                if ( limit is not None and
+                     'reject' == limit[ 'over_limit' ] and
+                     limit[ 'running' ] >= limit[ 'max_concurrent' ] ):
+                    limit[ 'rejected' ] += 1
+                    self._opsSocket.reply( envelope, self._busyReply( msg ) )
+                    continue
+                self._nBusy += 1
+                self._intervalStats[ 'max_busy' ] = max( self._intervalStats[ 'max_busy' ], self._nBusy )
+                if type( msg ) is dict and 'req' in msg:
+                    action = msg[ 'req' ]
+                    self.log( "Received: %s" % action )
+                    _requestContext.deadline = deadline
+                    if rid is not None:
+                        self._running[ rid ] = gevent.getcurrent()
+                    if limit is not None:
+                        self._enterLimit( action, limit )
+                    try:
+                        ret = self._dispatch( action, msg )
+                    except _RequestCancelled:
+                        self._nCancelled += 1
+                        ret = errorMessage( 'cancelled' )
+                    except gevent.GreenletExit:
+                        raise
+                    except:
+                        ret = errorMessage( 'exception', { 'st' : traceback.format_exc() } )
+                    finally:
+                        _requestContext.deadline = None
+                        if rid is not None:
+                            self._running.pop( rid, None )
+                        if limit is not None:
+                            self._exitLimit( action, limit )
+                    if ret is True:
+                        ret = successMessage()
+                    elif type( ret ) is str or type( ret ) is unicode:
+                        ret = errorMessage( ret )
+                    self._opsSocket.reply( envelope, ret )
+                else:
+                    self._opsSocket.reply( envelope, errorMessage( 'invalid request' ) )
+                self._nBusy -= 1
+                self._nProcessed += 1
+                stats = self._intervalStats
+                stats[ 'processed' ] += 1
+                stats[ 'queue_delay' ] += start - receivedAt
+                latency = time.time() - start
+                stats[ 'latency' ] += latency
+                if self._avgLatency is None:
+                    self._avgLatency = latency
+                else:
+                    self._avgLatency += ( latency - self._avgLatency ) * 0.1
+        finally:
+            if lane is None:
+                self._nHandlers -= 1
             else:
-                z.send( errorMessage( 'invalid request' ) )
+                self._lanes[ lane ][ 'handlers' ] -= 1
         self.log( "Stopping processing Actor ops requests" )
 
+    @classmethod
+    def _getRequestMetadata( cls, msg ):
+        # Anything malformed is ignored, it must not take down the handlers
+        if type( msg ) is not dict:
+            return ( None, None )
+        deadline = msg.get( '_deadline', None )
+        if type( deadline ) not in ( int, long, float ):
+            deadline = None
+        rid = msg.get( '_rid', None )
+        if not isinstance( rid, basestring ):
+            rid = None
+        return ( deadline, rid )
+
+    def _cancelRequest( self, msg ):
+        # Served straight from the socket so it doesn't wait behind the requests
+        # it may be cancelling.
+        deadline, rid = self._getRequestMetadata( msg )
+        if rid is None:
+            return errorMessage( 'missing request id' )
+        handler = self._running.get( rid, None )
+        if handler is not None:
+            gevent.get_hub().loop.run_callback( self._throwCancel, handler, rid )
+        else:
+            # It may still be in the mailbox, or not even there yet
+            now = time.time()
+            if 10000 < len( self._cancelled ):
+                for oldRid, cancelledAt in self._cancelled.items():
+                    if cancelledAt < now - 60:
+                        del( self._cancelled[ oldRid ] )
+            self._cancelled[ rid ] = now
+        return successMessage()
+
+    def _throwCancel( self, handler, rid ):
+        # The handler may have moved on to another request since we were scheduled
+        if self._running.get( rid, None ) is handler:
+            handler.throw( _RequestCancelled() )
+
+    def _dispatch( self, action, msg ):
+        ttl = self._cacheTtls.get( action, None )
+        if ttl is None:
+            return self._runHandler( action, msg )
+
+        # The request metadata is not part of what the handler computes on
+        key = _ResultCache.getKey( action, msg, ( 'req', '_deadline', '_rid' ) )
+        isHit, ret = self._resultCache.get( key )
+        if isHit:
+            return ret
+        ret = self._runHandler( action, msg )
+        # Anything but an error is a reply worth keeping, see handle()
+        if not ( type( ret ) is str or type( ret ) is unicode or ret is False or
+                 ( type( ret ) is dict and
+                   type( ret.get( 'status', None ) ) is dict and
+                   not ret[ 'status' ].get( 'success', True ) ) ):
+            self._resultCache.set( key, ret, ttl )
+        return ret
+
+    def invalidateCache( self, requestType = None, data = None ):
+        '''Drop cached results of handlers registered with a cacheTtl.
+
+        :param requestType: only drop the results of this request type, by default
+            all cached results are dropped
+        :param data: only drop the result of the request of requestType with this data
+        '''
+        if data is not None:
+            if requestType is None:
+                raise ValueError( 'invalidating data requires a request type' )
+            self._resultCache.invalidate( key = _ResultCache.getKey( requestType, data, ( 'req', '_deadline', '_rid' ) ) )
+        else:
+            self._resultCache.invalidate( name = requestType )
+
+    def _runHandler( self, action, msg ):
+        handler = self._handlers.get( action, self._defaultHandler )
+        offload = self._offloads.get( action, None )
+        if offload is None:
+            return handler( msg )
+
+        # The handler runs outside the hub, we only wait for its result here
+        if 'process' == offload:
+            if self._processPool is None:
+                # The handler was registered after init(), the workers get forked now
+                self._processPool = _ProcessPool( self, self._processPoolSize )
+            ret, queueTime = self._processPool.apply( action, msg )
+        else:
+            ret, queueTime = self._getThreadPool().apply( self._runOffloaded, ( handler, msg, time.time() ) )
+        stats = self._offloadStats.setdefault( offload, { 'calls' : 0,
+                                                          'queue_time' : 0.0,
+                                                          'max_queue_time' : 0.0 } )
+        stats[ 'calls' ] += 1
+        stats[ 'queue_time' ] += queueTime
+        stats[ 'max_queue_time' ] = max( stats[ 'max_queue_time' ], queueTime )
+        return ret
+
+    def _runOffloaded( self, handler, msg, queuedAt ):
+        queueTime = time.time() - queuedAt
+        try:
+            ret = handler( msg )
+        except:
+            ret = errorMessage( 'exception', { 'st' : traceback.format_exc() } )
+        return ( ret, queueTime )
+
+    def _busyReply( self, msg ):
+        # The hint is how long it should take us to get through the mailbox
+        latency = self._avgLatency if self._avgLatency is not None else 0.1
+        retryAfter = self._opsSocket.getQueueDepth( self._getLane( msg ) ) * latency / max( self._targetHandlers, 1 )
+        return errorMessage( 'busy', { 'retry_after' : min( max( retryAfter, 0.01 ), 10 ) } )
+
     def _defaultHandler( self, msg ):
         return errorMessage( 'request type not supported by actor' )
 
@@ -153,7 +700,7 @@ class Actor( gevent.Greenlet ):
         '''
         return not self.ready()
 
-    def handle( self, requestType, handlerFunction ):
+    def handle( self, requestType, handlerFunction, offload = None, lane = None, maxConcurrent = None, overLimit = 'wait', cacheTtl = None ):
         '''Initiates a callback for a specific type of request.
 
         :param requestType: the string representing the type of request to handle
@@ -162,12 +709,68 @@ class Actor( gevent.Greenlet ):
             to reply to the message. If it returns True, a generic success message will
             be replied, and if it returns a simple string, it will reply a generic error
             message where the string is the error message. To return data, return a dict.
+        :param offload: if 'thread', the handler runs in the thread pool of the instance
+            so blocking or cpu heavy work doesn't freeze the other actors, if 'process'
+            it runs in a pool of processes forked from the actor after init() so cpu
+            heavy work can use all the cores, those processes only see the state the
+            actor had when they were forked. Either way the handler must not use
+            gevent (sleep, actor handles...). Unless given a lane, requests offloaded
+            to processes are served by threads of their own, one per process, so
+            the other handlers keep their concurrency
+        :param lane: the name of the lane the requests wait in, they get a queue
+            separate from the other lanes and are scheduled according to SetLane()
+        :param maxConcurrent: the maximum number of requests of this type handled at
+            the same time, so a slow request type can't take all the handlers
+        :param overLimit: what happens to requests over maxConcurrent, with 'wait' they
+            wait in a queue of their own, with 'reject' they get a 'busy' reply right away
+        :param cacheTtl: if set, the replies of the handler other than errors are cached for
+            this many seconds and requests with the same data get the cached reply,
+            only use it with handlers whose reply depends only on the request data,
+            use invalidateCache() to drop cached replies that are no longer valid
         :returns: the previous handler for the request type or None if None existed
         '''
+        if offload not in ( None, 'thread', 'process' ):
+            raise ValueError( 'unknown offload mode: %s' % offload )
+        if overLimit not in ( 'wait', 'reject' ):
+            raise ValueError( 'unknown over limit mode: %s' % overLimit )
+        if maxConcurrent is not None and maxConcurrent < 1:
+            raise ValueError( 'maxConcurrent must be at least 1' )
         old = None
         if requestType in self._handlers:
             old = self._handlers[ requestType ]
         self._handlers[ requestType ] = handlerFunction
+        if offload is None:
+            self._offloads.pop( requestType, None )
+        else:
+            self._offloads[ requestType ] = offload
+        if 'process' == offload and lane is None:
+            # Waiting on the workers must not take the handlers of other requests,
+            # nor make them concurrent
+            lane = self._processLane
+            self.SetLane( lane, minHandlers = self._processPoolSize, isExclusive = True )
+        if lane is None:
+            self._requestLanes.pop( requestType, None )
+        else:
+            self._requestLanes[ requestType ] = lane
+        # Replies cached from the previous handler may not be what this one replies
+        self._resultCache.invalidate( name = requestType )
+        if cacheTtl is None:
+            self._cacheTtls.pop( requestType, None )
+        else:
+            self._cacheTtls[ requestType ] = cacheTtl
+        if maxConcurrent is None:
+            limit = self._limits.pop( requestType, None )
+            if limit is not None:
+                self._opsSocket.resume( ( lane, requestType ) )
+        else:
+            # Requests already running keep counting against the new limit
+            limit = self._limits.setdefault( requestType, { 'running' : 0, 'rejected' : 0 } )
+            limit[ 'max_concurrent' ] = maxConcurrent
+            limit[ 'over_limit' ] = overLimit
+            if 'reject' == overLimit or limit[ 'running' ] < maxConcurrent:
+                self._opsSocket.resume( ( lane, requestType ) )
+            else:
+                self._opsSocket.pause( ( lane, requestType ) )
         return old
 
     def schedule( self, delay, func, *args, **kw_args ):
@@ -221,6 +824,22 @@ class Actor( gevent.Greenlet ):
         self._vHandles.append( v )
         return v
 
+    def getActorHandles( self, categories = None, mode = 'random', prefix = None ):
+        '''Get virtual handles to multiple categories at once, the directory for all
+            of them is fetched in a single request.
+
+        :param categories: a list of category names to get handles to
+        :param mode: the method actors are queried by the handles, same as getActorHandle
+        :param prefix: instead of a list of categories, get handles to all the categories
+            currently in the directory starting with this prefix
+        :returns: a dict of category name to ActorHandle
+        '''
+        if categories is None and prefix is None:
+            raise ValueError( 'either categories or a prefix is required' )
+        handles = ActorHandle._newHandles( self._realm, categories, mode, prefix )
+        self._vHandles += handles.values()
+        return handles
+
     def isCategoryAvailable( self, category ):
         '''Checks if actors are available in the category.
 
@@ -241,6 +860,7 @@ class Actor( gevent.Greenlet ):
 class ActorHandle ( object ):
         _zHostDir = None
         _zDir = []
+        _dirMirror = None
 
         @classmethod
         def _getNAvailableInCat( cls, realm, cat ):
@@ -252,21 +872,109 @@ class ActorHandle ( object ):
 
         @classmethod
         def _getDirectory( cls, realm, cat ):
+            endpoints, gen = cls._getDirectoryIfChanged( realm, cat )
+            return endpoints
+
+        @classmethod
+        def _getMirroredDirectory( cls ):
+            # Actors running on a node read the directory published by their HostManager
+            # in shared memory and only go to the directory service if it's unavailable.
+            mirror = None
+            if cls._dirMirror is not None:
+                mirror = cls._dirMirror.read()
+            return mirror
+
+        @classmethod
+        def _getMirroredEntry( cls, mirror, realm, cat, gen = None ):
+            endpoints = mirror[ 'realms' ].get( realm, {} ).get( cat, {} )
+            newGen = '%s-%d' % ( mirror[ 'epoch' ], mirror[ 'gens' ].get( realm, {} ).get( cat, 0 ) )
+            if gen == newGen:
+                endpoints = None
+            return ( endpoints, newGen )
+
+        @classmethod
+        def _pickDirNode( cls ):
+            if 0 == len( cls._zDir ):
+                return None
+            return cls._zDir[ random.randint( 0, len( cls._zDir ) - 1 ) ]
+
+        @classmethod
+        def _getDirectoryIfChanged( cls, realm, cat, gen = None, z = None ):
+            # Generations are only comparable on the node that issued them, so
+            # callers holding a generation should ask that same node.
             msg = False
-            if 0 != len( cls._zDir ):
-                z = cls._zDir[ random.randint( 0, len( cls._zDir ) - 1 ) ]
+            newGen = None
+            mirror = cls._getMirroredDirectory()
+            if mirror is None and z is None:
+                z = cls._pickDirNode()
+            if mirror is not None:
+                msg, newGen = cls._getMirroredEntry( mirror, realm, cat, gen )
+            elif z is not None:
                 # These requests can be sent to the directory service of a HostManager
                 # or the ops service of the HostManager. Directory service is OOB from the
                 # ops but is only available locally to Actors. The ops is available from outside
                 # the host. So if the ActorHandle is created by an Actor, it goes to the dir_svc
                 # and if it's created from outside components through a Beach it goes to
                 # the ops.
-                msg = z.request( data = { 'req' : 'get_dir', 'realm' : realm, 'cat' : cat } )
-                if isMessageSuccess( msg ) and 'endpoints' in msg:
+                req = { 'req' : 'get_dir', 'realm' : realm, 'cat' : cat }
+                if gen is not None:
+                    req[ 'gen' ] = gen
+                msg = z.request( data = req, timeout = 10 )
+                if isMessageSuccess( msg ) and msg.get( 'not_modified', False ):
+                    # None means the endpoints we have for this generation are still current
+                    newGen = msg.get( 'gen', None )
+                    msg = None
+                elif isMessageSuccess( msg ) and 'endpoints' in msg:
+                    newGen = msg.get( 'gen', None )
                     msg = msg[ 'endpoints' ]
                 else:
                     msg = False
-            return msg
+            return ( msg, newGen )
+
+        @classmethod
+        def _getDirectories( cls, realm, cats = None, prefix = None, z = None ):
+            # Returns a dict of category to ( endpoints, gen ) fetched in a single request
+            # or False if the request failed.
+            dirs = False
+            mirror = cls._getMirroredDirectory()
+            if mirror is None and z is None:
+                z = cls._pickDirNode()
+            if mirror is not None:
+                if cats is None:
+                    cats = [ x for x in mirror[ 'realms' ].get( realm, {} ).keys() if x.startswith( prefix ) ]
+                dirs = {}
+                for cat in cats:
+                    dirs[ cat ] = cls._getMirroredEntry( mirror, realm, cat )
+            elif z is not None:
+                req = { 'req' : 'get_dirs', 'realm' : realm }
+                if cats is not None:
+                    req[ 'cats' ] = [ ( realm, cat ) for cat in cats ]
+                else:
+                    req[ 'cat_prefix' ] = prefix
+                msg = z.request( data = req, timeout = 10 )
+                if isMessageSuccess( msg ) and 'dirs' in msg:
+                    dirs = {}
+                    for cat, entry in msg[ 'dirs' ].get( realm, {} ).iteritems():
+                        dirs[ cat ] = ( entry.get( 'endpoints', {} ), entry.get( 'gen', None ) )
+            return dirs
+
+        @classmethod
+        def _newHandles( cls, realm, categories = None, mode = 'random', prefix = None ):
+            # Warm all the handles with one directory request instead of one per category,
+            # handles we could not get a directory for will fetch it themselves.
+            z = cls._pickDirNode()
+            dirs = cls._getDirectories( realm, cats = categories, prefix = prefix, z = z )
+            if dirs is False:
+                dirs = {}
+                z = None
+            if categories is None:
+                categories = dirs.keys()
+            handles = {}
+            for cat in categories:
+                handles[ cat ] = cls( realm, cat, mode, prefetched = dirs.get( cat, None ) )
+                if cat in dirs:
+                    handles[ cat ]._dirNode = z
+            return handles
 
         @classmethod
         def _setHostDirInfo( cls, zHostDir ):
@@ -277,19 +985,42 @@ class ActorHandle ( object ):
                 for h in zHostDir:
                     cls._zDir.append( _ZMREQ( h, isBind = False ) )
 
-        def __init__( self, realm, category, mode = 'random' ):
+        @classmethod
+        def _setHostDirMirror( cls, path ):
+            if cls._dirMirror is None:
+                cls._dirMirror = _DirectoryMirror( path )
+
+        def __init__( self, realm, category, mode = 'random', prefetched = None ):
             self._cat = category
             self._realm = realm
             self._mode = mode
             self._endpoints = {}
+            self._dirGen = None
+            # The node our generation comes from, refreshes stick to it until it fails
+            self._dirNode = None
             self._srcSockets = []
+            self._busyUntil = {}
             self._threads = gevent.pool.Group()
-            self._threads.add( gevent.spawn_later( 0, self._svc_refreshDir ) )
+            if prefetched is not None:
+                self._endpoints, self._dirGen = prefetched
+                self._scheduleRefresh()
+            else:
+                self._threads.add( gevent.spawn_later( 0, self._svc_refreshDir ) )
 
         def _svc_refreshDir( self ):
-            newDir = self._getDirectory( self._realm, self._cat )
+            if self._dirNode is None:
+                self._dirNode = self._pickDirNode()
+            newDir, newGen = self._getDirectoryIfChanged( self._realm, self._cat, self._dirGen, self._dirNode )
             if newDir is not False:
-                self._endpoints = newDir
+                if newDir is not None:
+                    self._endpoints = newDir
+                self._dirGen = newGen
+            else:
+                # The next refresh tries another node, with a full reply from it
+                self._dirNode = None
+            self._scheduleRefresh()
+
+        def _scheduleRefresh( self ):
             if 0 == len( self._endpoints ):
                 # No Actors yet, be more agressive to look for some
                 self._threads.add( gevent.spawn_later( 2, self._svc_refreshDir ) )
@@ -301,7 +1032,9 @@ class ActorHandle ( object ):
 
             :param requestType: the type of request to issue
             :param data: a dict of the data associated with the request
-            :param timeout: the number of seconds to wait for a response
+            :param timeout: the number of seconds to wait for a response, the actor
+                drops the request if it only gets to it after that, when called from
+                a handler it is capped to the time left to the request being handled
             :param key: when used in 'affinity' mode, the key is the main parameter
                 to evaluate to determine which Actor to send the request to, in effect
                 it is the key to the hash map of Actors
@@ -309,11 +1042,20 @@ class ActorHandle ( object ):
                 times out, meaning a timeout of 5 and a retry of 3 could result in
                 a request taking 15 seconds to return
             :returns: the response to the request as a dict, or False in the event
-                the request failed or timed out
+                the request failed or timed out, if all the Actors tried are busy the
+                'busy' error of the last one is returned
             '''
             z = None
             ret = False
             curRetry = 0
+            nBusy = 0
+
+            remaining = _getRemainingTime()
+            if remaining is not None:
+                if remaining <= 0:
+                    return False
+                if timeout is None or timeout > remaining:
+                    timeout = remaining
 
             while curRetry <= nRetries:
                 try:
@@ -330,14 +1072,14 @@ class ActorHandle ( object ):
                                                                           key = lambda x: x.__getitem__( 0 ) ) ]
                                 z = sortedActors[ hash( key ) % len( sortedActors ) ]
                                 z = _ZSocket( zmq.REQ, z )
-                            elif 0 != len( self._srcSockets ):
+                            else:
                                 # Prioritize existing connections, only create new one
                                 # based on the mode when we have no connections available
-                                z = self._srcSockets.pop()
-                            elif 'random' == self._mode:
-                                endpoints = self._endpoints.values()
-                                if 0 != len( endpoints ):
-                                    z = _ZSocket( zmq.REQ, endpoints[ random.randint( 0, len( endpoints ) - 1 ) ] )
+                                z = self._popSocket()
+                                if z is None and 'random' == self._mode:
+                                    endpoints = self._getNotBusyEndpoints()
+                                    if 0 != len( endpoints ):
+                                        z = _ZSocket( zmq.REQ, endpoints[ random.randint( 0, len( endpoints ) - 1 ) ] )
                             if z is None:
                                 gevent.sleep( 0.001 )
                 except _TimeoutException:
@@ -346,13 +1088,41 @@ class ActorHandle ( object ):
                 if z is not None and curRetry <= nRetries:
                     if type( data ) is not dict:
                         data = { 'data' : data }
+                    else:
+                        # The metadata must not stick to the caller's dict, it may be
+                        # reused for other requests, or be the default argument
+                        data = dict( data )
                     data[ 'req' ] = requestType
-
-                    ret = z.request( data, timeout = timeout )
+                    if timeout is not None:
+                        data[ '_deadline' ] = time.time() + timeout
+                    else:
+                        # Could come from a request being forwarded as-is
+                        data.pop( '_deadline', None )
+                    data[ '_rid' ] = uuid.uuid4().hex
+
+                    try:
+                        ret = z.request( data, timeout = timeout )
+                    except gevent.GreenletExit:
+                        # We're being killed, or the request we serve was cancelled,
+                        # the actor doesn't need to finish this one either.
+                        self._cancel( z._url, data[ '_rid' ] )
+                        z.close()
+                        raise
+                    if ret is False:
+                        self._cancel( z._url, data[ '_rid' ] )
                     # If we hit a timeout we don't take chances
                     # and remove that socket
                     if ret is not False:
                         self._srcSockets.append( z )
+                        retryAfter = self._getRetryAfter( ret )
+                        if retryAfter is not None:
+                            self._busyUntil[ z._url ] = time.time() + retryAfter
+                        z = None
+                        if ( retryAfter is not None and 'affinity' != self._mode and
+                             nBusy < len( self._endpoints ) ):
+                            # That actor is shedding load, we try another one
+                            nBusy += 1
+                            continue
                         break
                     else:
                         z.close()
@@ -364,6 +1134,45 @@ class ActorHandle ( object ):
 
             return ret
 
+        def _cancel( self, endpoint, rid ):
+            # Sent from its own greenlet since the one abandoning the request may be dying
+            gevent.spawn( self._sendCancel, endpoint, rid )
+
+        def _sendCancel( self, endpoint, rid ):
+            z = _ZSocket( zmq.REQ, endpoint )
+            try:
+                z.request( { 'req' : '__cancel', '_rid' : rid }, 5 )
+            finally:
+                z.close()
+
+        def _getRetryAfter( self, ret ):
+            # Returns how long the actor asked not to be sent requests if it replied busy
+            if isMessageSuccess( ret ) or 'busy' != ret.get( 'status', {} ).get( 'error', None ):
+                return None
+            return ret.get( 'data', {} ).get( 'retry_after', 0.1 )
+
+        def _getNotBusyEndpoints( self ):
+            now = time.time()
+            for endpoint, until in self._busyUntil.items():
+                if until <= now:
+                    del( self._busyUntil[ endpoint ] )
+            endpoints = [ x for x in self._endpoints.values() if x not in self._busyUntil ]
+            if 0 == len( endpoints ):
+                # Everyone is busy, the best we can do is keep spreading the load
+                endpoints = self._endpoints.values()
+            return endpoints
+
+        def _popSocket( self ):
+            if 0 == len( self._srcSockets ):
+                return None
+            if 0 == len( self._busyUntil ):
+                return self._srcSockets.pop()
+            notBusy = self._getNotBusyEndpoints()
+            for i in range( len( self._srcSockets ) - 1, -1, -1 ):
+                if self._srcSockets[ i ]._url in notBusy:
+                    return self._srcSockets.pop( i )
+            return None
+
         def broadcast( self, requestType, data = {} ):
             '''Issue a request to the all actors in the category of this handle.
 
@@ -22,6 +22,7 @@ from gevent import Greenlet
 from gevent.event import Event
 from beach.utils import *
 from beach.utils import _ZMREP
+from beach.utils import _ModuleCache
 import imp
 import zmq.green as zmq
 from beach.actor import *
@@ -70,6 +71,13 @@ class ActorHost ( object ):
 
         self.codeDirectory = os.path.abspath( self.configFile.get( 'code_directory', './' ) )
 
+        codeCacheDirectory = self.configFile.get( 'code_cache_directory', '/tmp/py_beach_code_cache' ) or None
+        self.moduleCache = _ModuleCache( codeCacheDirectory )
+        if codeCacheDirectory is not None and not self.moduleCache.isDiskCached():
+            self.logCritical( "Code cache directory %s is not private (mode 0700, owned by us), not using it" % codeCacheDirectory )
+        Actor._setModuleCache( self.moduleCache )
+        Actor._setThreadPoolSize( self.configFile.get( 'handler_thread_pool_size', 10 ) )
+
         self.opsSocket = _ZMREP( 'ipc:///tmp/py_beach_instance_%s' % instanceId, isBind = True )
         self.log( "Listening for ops on %s" % ( 'ipc:///tmp/py_beach_instance_%s' % instanceId, ) )
         
@@ -78,6 +86,9 @@ class ActorHost ( object ):
 
         ActorHandle._setHostDirInfo( self.configFile.get( 'directory_port',
                                                           'ipc:///tmp/py_beach_directory_port' ) )
+        mirrorPath = self.configFile.get( 'directory_mirror', '/tmp/py_beach_directory_mirror' )
+        if mirrorPath:
+            ActorHandle._setHostDirMirror( mirrorPath )
         
         gevent.spawn( self.svc_receiveTasks )
         gevent.spawn( self.svc_monitorActors )
@@ -105,63 +116,86 @@ class ActorHost ( object ):
                 if 'keepalive' == action:
                     z.send( successMessage() )
                 elif 'start_actor' == action:
-                    if 'actor_name' not in data or 'port' not in data or 'uid' not in data:
-                        z.send( errorMessage( 'missing information to start actor' ) )
+                    z.send( self._startActor( data ) )
+                elif 'start_actors' == action:
+                    if 'actors' not in data:
+                        z.send( errorMessage( 'missing information to start actors' ) )
                     else:
-                        actorName = data[ 'actor_name' ]
-                        realm = data.get( 'realm', 'global' )
-                        parameters = data.get( 'parameters', {} )
-                        ip = data[ 'ip' ]
-                        port = data[ 'port' ]
-                        uid = data[ 'uid' ]
-                        fileName = '%s/%s/%s.py' % ( self.codeDirectory, realm, actorName )
-                        with open( fileName, 'r' ) as hFile:
-                            fileHash = hashlib.sha1( hFile.read() ).hexdigest()
-                        self.log( "Starting actor %s/%s at %s/%s/%s.py" % ( realm,
-                                                                            actorName,
-                                                                            self.codeDirectory,
-                                                                            realm,
-                                                                            actorName ) )
-                        try:
-                            actor = getattr( imp.load_source( '%s_%s_%s' % ( realm, actorName, fileHash ),
-                                                              '%s/%s/%s.py' % ( self.codeDirectory,
-                                                                                realm,
-                                                                                actorName ) ),
-                                             actorName )( self, realm, ip, port, uid, parameters )
-                        except:
-                            actor = None
-
-                        if actor is not None:
-                            self.log( "Successfully loaded actor %s/%s" % ( realm, actorName ) )
-                            self.actors[ uid ] = actor
-                            actor.start()
-                            z.send( successMessage() )
-                        else:
-                            z.send( errorMessage( 'exception',
-                                                               data = { 'st' : traceback.format_exc() } ) )
+                        z.send( successMessage( { 'results' : [ self._startActor( x ) for x in data[ 'actors' ] ] } ) )
+                elif 'get_metrics' == action:
+                    threadPool = Actor._threadPool
+                    z.send( successMessage( { 'module_cache' : self.moduleCache.getMetrics(),
+                                              'thread_pool' : { 'size' : Actor._threadPoolSize,
+                                                                'pending' : len( threadPool ) if threadPool is not None else 0 },
+                                              'actors' : dict( ( uid, actor.getMetrics() )
+                                                               for uid, actor in self.actors.items() ) } ) )
                 elif 'kill_actor' == action:
                     if 'uid' not in data:
                         z.send( errorMessage( 'missing information to stop actor' ) )
                     else:
-                        uid = data[ 'uid' ]
-                        if uid in self.actors:
-                            actor = self.actors[ uid ]
-                            del( self.actors[ uid ] )
-                            actor.stop()
-                            actor.join( timeout = 10 )
-                            info = None
-                            if not actor.ready():
-                                actor.kill( timeout = 10 )
-                                info = { 'error' : 'timeout' }
-                            z.send( successMessage( data = info ) )
-                        else:
-                            z.send( errorMessage( 'actor not found' ) )
+                        z.send( self._stopActors( ( data[ 'uid' ], ) )[ data[ 'uid' ] ] )
+                elif 'kill_actors' == action:
+                    if 'uids' not in data:
+                        z.send( errorMessage( 'missing information to stop actors' ) )
+                    else:
+                        z.send( successMessage( { 'results' : self._stopActors( data[ 'uids' ] ) } ) )
                 else:
                     z.send( errorMessage( 'unknown request', data = { 'req' : action } ) )
             else:
                 self.logCritical( "Received completely invalid request" )
                 z.send( errorMessage( 'invalid request' ) )
 
+    def _startActor( self, data ):
+        if 'actor_name' not in data or 'port' not in data or 'uid' not in data:
+            return errorMessage( 'missing information to start actor' )
+
+        actorName = data[ 'actor_name' ]
+        realm = data.get( 'realm', 'global' )
+        parameters = data.get( 'parameters', {} )
+        ip = data[ 'ip' ]
+        port = data[ 'port' ]
+        uid = data[ 'uid' ]
+        # The HostManager can point us to a local bundle of the realm's code
+        codeDirectory = data.get( 'code_directory', self.codeDirectory )
+        fileName = '%s/%s/%s.py' % ( codeDirectory, realm, actorName )
+        self.log( "Starting actor %s/%s at %s" % ( realm, actorName, fileName ) )
+        try:
+            actor = getattr( self.moduleCache.load( fileName, '%s_%s' % ( realm, actorName ) ),
+                             actorName )( self, realm, ip, port, uid, parameters )
+        except:
+            return errorMessage( 'exception', data = { 'st' : traceback.format_exc() } )
+
+        self.log( "Successfully loaded actor %s/%s" % ( realm, actorName ) )
+        self.actors[ uid ] = actor
+        actor.start()
+        return successMessage()
+
+    def _stopActors( self, uids ):
+        results = {}
+        toStop = []
+        for uid in uids:
+            actor = self.actors.pop( uid, None )
+            if actor is None:
+                results[ uid ] = errorMessage( 'actor not found' )
+            else:
+                actor.stop()
+                toStop.append( ( uid, actor ) )
+
+        # All the actors get to stop at the same time, the ones that don't
+        # make it in time get killed together.
+        gevent.joinall( [ actor for uid, actor in toStop ], timeout = 10 )
+        stragglers = [ actor for uid, actor in toStop if not actor.ready() ]
+        if 0 != len( stragglers ):
+            gevent.killall( stragglers, timeout = 10 )
+
+        for uid, actor in toStop:
+            info = None
+            if actor in stragglers:
+                info = { 'error' : 'timeout' }
+            results[ uid ] = successMessage( data = info )
+
+        return results
+
     def svc_monitorActors( self ):
         z = self.hostOpsSocket.getChild()
         while not self.stopEvent.wait( 0 ):
@@ -94,9 +94,8 @@ class Beach ( object ):
         for nodeName, node in self._nodes.items():
             self._nodes[ nodeName ][ 'info' ] = self._getHostInfo( node[ 'socket' ] )
 
-        tmpDir = self.getDirectory()
-        if isMessageSuccess( tmpDir ):
-            self._dirCache = tmpDir[ 'realms' ].get( self._realm, {} )
+        # getDirectory() refreshes the cache of our own realm
+        self.getDirectory( realm = self._realm )
 
         self._isInited.set()
         gevent.spawn_later( 30, self._updateNodes )
@@ -147,13 +146,105 @@ class Beach ( object ):
 
         thisRealm = realm if realm is not None else self._realm
 
+        nodeName = self._chooseNode( strategy, strategy_hint )
+        if nodeName is not None:
+            node = self._nodes[ nodeName ].get( 'socket', None )
+
+        if node is not None:
+            info = { 'req' : 'start_actor',
+                     'actor_name' : actorName,
+                     'realm' : thisRealm,
+                     'cat' : category,
+                     'isolated' : isIsolated }
+            if parameters is not None:
+                info[ 'parameters' ] = parameters
+            resp = node.request( info, timeout = 10 )
+
+        return resp
+
+    def addActors( self, actorName, category, count, strategy = 'random', strategy_hint = None, realm = None, parameters = None, isIsolated = False ):
+        '''Spawn many actors of the same kind in the cluster at once.
+
+        :param actorName: the name of the actor to spawn
+        :param category: the category associated with the new actors
+        :param count: the number of actors to spawn
+        :param strategy: the strategy to use to decide where to spawn the new actors, supports
+            the same strategies as addActor as well as round_robin which spreads the actors
+            evenly across nodes, with resource the actors are spread in proportion to the
+            free resources of each node
+        :param strategy_hint: a parameter to help choose a node, meaning depends on the strategy
+        :param realm: the realm to add the actors in, if different than main realm set
+        :param parameters: a dict of parameters that will be given to the actors when they start
+        :param isIsolated: if True each Actor will be spawned in its own process space
+
+        :returns: a list of the replies for each actor, each successful reply contains the
+            'uid' of the new actor
+        '''
+        thisRealm = realm if realm is not None else self._realm
+
+        # First we plan how many actors go on which node, then every node gets
+        # a single request for all its actors and all nodes are contacted in parallel.
+        plan = {}
+        nodeNames = self._nodes.keys()
+        if 'round_robin' == strategy:
+            offset = random.randint( 0, len( nodeNames ) - 1 )
+            for n in range( count ):
+                nodeName = nodeNames[ ( offset + n ) % len( nodeNames ) ]
+                plan[ nodeName ] = plan.get( nodeName, 0 ) + 1
+        elif 'resource' == strategy:
+            free = {}
+            for nodeName in nodeNames:
+                info = self._nodes[ nodeName ][ 'info' ]
+                load = 100
+                if info is not None:
+                    load = ( sum( info[ 'cpu' ] ) / len( info[ 'cpu' ] ) + info[ 'mem' ] ) / 2
+                free[ nodeName ] = max( 100 - load, 1 )
+            for n in range( count ):
+                # Give the next actor to the node furthest below its fair share
+                nodeName = min( nodeNames, key = lambda x: float( plan.get( x, 0 ) + 1 ) / free[ x ] )
+                plan[ nodeName ] = plan.get( nodeName, 0 ) + 1
+        else:
+            for n in range( count ):
+                nodeName = self._chooseNode( strategy, strategy_hint )
+                if nodeName is not None:
+                    plan[ nodeName ] = plan.get( nodeName, 0 ) + 1
+
+        def _startOnNode( nodeName, nActors ):
+            info = { 'req' : 'start_actors',
+                     'actor_name' : actorName,
+                     'realm' : thisRealm,
+                     'cat' : category,
+                     'isolated' : isIsolated,
+                     'count' : nActors }
+            if parameters is not None:
+                info[ 'parameters' ] = parameters
+            resp = self._nodes[ nodeName ][ 'socket' ].request( info, timeout = 10 + nActors )
+            if isMessageSuccess( resp ):
+                results = resp[ 'actors' ]
+            elif resp is not False and 'actors' in resp.get( 'data', {} ):
+                results = resp[ 'data' ][ 'actors' ]
+            else:
+                results = [ errorMessage( 'node failed to start actors', { 'node' : nodeName } ) ] * nActors
+            return results
+
+        jobs = [ gevent.spawn( _startOnNode, nodeName, nActors ) for nodeName, nActors in plan.items() ]
+        gevent.joinall( jobs )
+
+        results = []
+        for job in jobs:
+            results += job.value
+        return results
+
+    def _chooseNode( self, strategy, strategy_hint ):
+        node = None
+
         if 'random' == strategy or strategy is None:
-            node = self._nodes.values()[ random.randint( 0, len( self._nodes ) - 1 ) ][ 'socket' ]
+            node = self._nodes.keys()[ random.randint( 0, len( self._nodes ) - 1 ) ]
         elif 'resource' == strategy:
             # For now the simple version of this strategy is to just average the CPU and MEM %.
-            node = min( self._nodes.values(), key = lambda x: ( sum( x[ 'info' ][ 'cpu' ] ) /
-                                                                len( x[ 'info' ][ 'cpu' ] ) +
-                                                                x[ 'info' ][ 'mem' ] ) / 2 )[ 'socket' ]
+            node = min( self._nodes.keys(), key = lambda x: ( sum( self._nodes[ x ][ 'info' ][ 'cpu' ] ) /
+                                                              len( self._nodes[ x ][ 'info' ][ 'cpu' ] ) +
+                                                              self._nodes[ x ][ 'info' ][ 'mem' ] ) / 2 )
         elif 'affinity' == strategy:
             nodeList = self._dirCache.get( strategy_hint, {} ).values()
             population = {}
@@ -162,11 +253,10 @@ class Beach ( object ):
                 population.setdefault( name, 0 )
                 population[ name ] += 1
             if 0 != len( population ):
-                affinityNode = population.keys()[ random.randint( 0, len( population ) - 1 ) ]
-                node = self._nodes[ affinityNode ].get( 'socket', None )
+                node = population.keys()[ random.randint( 0, len( population ) - 1 ) ]
             else:
                 # There is nothing in play, fall back to random
-                node = self._nodes.values()[ random.randint( 0, len( self._nodes ) - 1 ) ][ 'socket' ]
+                node = self._nodes.keys()[ random.randint( 0, len( self._nodes ) - 1 ) ]
         elif 'repulsion' == strategy:
             possibleNodes = self._nodes.keys()
 
@@ -175,50 +265,79 @@ class Beach ( object ):
             for n in nodeList:
                 name = n.split( ':' )[ 1 ][ 2 : ]
                 if name in possibleNodes:
-                    del( possibleNodes[ name ] )
+                    possibleNodes.remove( name )
 
             if 0 != len( possibleNodes ):
-                affinityNode = possibleNodes[ random.randint( 0, len( possibleNodes ) - 1 ) ]
-                node = self._nodes[ affinityNode ].get( 'socket', None )
+                node = possibleNodes[ random.randint( 0, len( possibleNodes ) - 1 ) ]
             else:
                 # There is nothing in play, fall back to random
-                node = self._nodes.values()[ random.randint( 0, len( self._nodes ) - 1 ) ][ 'socket' ]
+                node = self._nodes.keys()[ random.randint( 0, len( self._nodes ) - 1 ) ]
 
-        if node is not None:
-            info = { 'req' : 'start_actor',
-                     'actor_name' : actorName,
-                     'realm' : thisRealm,
-                     'cat' : category,
-                     'isolated' : isIsolated }
-            if parameters is not None:
-                info[ 'parameters' ] = parameters
-            resp = node.request( info, timeout = 10 )
-
-        return resp
+        return node
 
-    def getDirectory( self ):
+    def getDirectory( self, realm = None, category = None, prefix = None, node = None, pageSize = None ):
         '''Retrieve the directory from a random node, all nodes have a directory that
             is eventually-consistent.
 
+        :param realm: only return the directory of this realm
+        :param category: only return the actors of this category
+        :param prefix: only return the actors of categories starting with this prefix
+        :param node: only return the actors running on the node with this ip
+        :param pageSize: retrieve the directory in pages of at most this many actors
+            instead of a single reply, the pages are merged before being returned
+
         :returns: the realm directory of the cluster
         '''
-        node = self._nodes.values()[ random.randint( 0, len( self._nodes ) - 1 ) ][ 'socket' ]
-        resp = node.request( { 'req' : 'get_full_dir' }, timeout = 10 )
+        zNode = self._nodes.values()[ random.randint( 0, len( self._nodes ) - 1 ) ][ 'socket' ]
+        req = { 'req' : 'get_full_dir' }
+        if realm is not None:
+            req[ 'realm' ] = realm
+        if category is not None:
+            req[ 'cat' ] = category
+        if prefix is not None:
+            req[ 'cat_prefix' ] = prefix
+        if node is not None:
+            req[ 'node' ] = node
+        if pageSize is not None:
+            req[ 'page_size' ] = pageSize
+
+        resp = zNode.request( req, timeout = 10 )
+        while isMessageSuccess( resp ) and resp.get( 'next', None ) is not None:
+            req[ 'after' ] = resp[ 'next' ]
+            page = zNode.request( req, timeout = 10 )
+            if not isMessageSuccess( page ):
+                resp = page
+                break
+            for realmName, categories in page[ 'realms' ].iteritems():
+                for cat, endpoints in categories.iteritems():
+                    resp[ 'realms' ].setdefault( realmName, {} ).setdefault( cat, {} ).update( endpoints )
+            resp[ 'next' ] = page.get( 'next', None )
+
         if isMessageSuccess( resp ):
-            self._dirCache = resp
+            if ( realm is None or realm == self._realm ) and category is None and prefix is None and node is None:
+                self._dirCache = resp[ 'realms' ].get( self._realm, {} )
         else:
             resp = False
         return resp
 
-    def flush( self ):
+    def flush( self, realm = None ):
         '''Unload all actors from the cluster, major operation, be careful.
 
+        :param realm: only unload the actors of this realm instead of all the realms
+
         :returns: True if all actors were removed normally
         '''
+        req = { 'req' : 'flush' }
+        if realm is not None:
+            req[ 'realm' ] = realm
+
+        # All nodes flush in parallel
+        jobs = [ gevent.spawn( node[ 'socket' ].request, req, timeout = 30 ) for node in self._nodes.values() ]
+        gevent.joinall( jobs )
+
         isFlushed = True
-        for node in self._nodes.values():
-            resp = node[ 'socket' ].request( { 'req' : 'flush' }, timeout = 30 )
-            if not isMessageSuccess( resp ):
+        for job in jobs:
+            if not isMessageSuccess( job.value ):
                 isFlushed = False
 
         return isFlushed
@@ -236,6 +355,23 @@ class Beach ( object ):
         self._vHandles.append( v )
         return v
 
+    def getActorHandles( self, categories = None, mode = 'random', prefix = None ):
+        '''Get virtual handles to multiple categories at once, the directory for all
+            of them is fetched in a single request.
+
+        :param categories: a list of category names to get handles to
+        :param mode: the method actors are queried by the handles, same as getActorHandle
+        :param prefix: instead of a list of categories, get handles to all the categories
+            currently in the directory starting with this prefix
+
+        :returns: a dict of category name to ActorHandle
+        '''
+        if categories is None and prefix is None:
+            raise ValueError( 'either categories or a prefix is required' )
+        handles = ActorHandle._newHandles( self._realm, categories, mode, prefix )
+        self._vHandles += handles.values()
+        return handles
+
     def stopActors( self, withId = None, withCategory = None ):
         '''Stop specific actors based on a criteria.
 
@@ -248,26 +384,67 @@ class Beach ( object ):
         toRemove = []
 
         if withId is not None:
-            if not isinstance( withId, collections.Iterable ):
+            if not isinstance( withId, collections.Iterable ) or isinstance( withId, basestring ):
                 toRemove.append( withId )
             else:
                 toRemove += withId
 
-        tmpDir = self.getDirectory()
+        tmpDir = self.getDirectory( realm = self._realm )
 
         if tmpDir is not False and isMessageSuccess( tmpDir ):
+            realmDir = tmpDir[ 'realms' ].get( self._realm, {} )
             if withCategory is not None:
-                if not isinstance( withCategory, collections.Iterable ):
+                if not isinstance( withCategory, collections.Iterable ) or isinstance( withCategory, basestring ):
                     withCategory = ( withCategory, )
                 for cat in withCategory:
-                    toRemove += tmpDir[ 'realms' ].get( self._realm, {} ).get( cat, {} ).keys()
+                    toRemove += realmDir.get( cat, {} ).keys()
+
+            # Each actor is only sent to the node it lives on, which we get from its endpoint.
+            owners = {}
+            for endpoints in realmDir.values():
+                for uid, endpoint in endpoints.iteritems():
+                    owners[ uid ] = endpoint.split( ':' )[ 1 ][ 2 : ]
+
+            perNode = {}
+            unknown = set()
+            for uid in toRemove:
+                owner = owners.get( uid, None )
+                if owner in self._nodes:
+                    perNode.setdefault( owner, [] ).append( uid )
+                else:
+                    unknown.add( uid )
+
+            # Actors missing from our copy of the directory may just not have been
+            # synced yet, so those still get sent to every node.
+            if 0 != len( unknown ):
+                for nodeName in self._nodes.keys():
+                    perNode.setdefault( nodeName, [] ).extend( unknown )
+
+            jobs = [ gevent.spawn( self._nodes[ nodeName ][ 'socket' ].request,
+                                   { 'req' : 'kill_actor', 'uid' : uids },
+                                   timeout = 30 ) for nodeName, uids in perNode.items() ]
+            gevent.joinall( jobs )
 
-            # We take the easy way out for now by just spamming the kill to every node.
             isSuccess = True
-            for node in self._nodes.values():
-                resp = node[ 'socket' ].request( { 'req' : 'kill_actor', 'uid' : toRemove }, timeout = 30 )
-                if not isMessageSuccess( resp ):
+            nNotFound = {}
+            for job in jobs:
+                resp = job.value
+                if isMessageSuccess( resp ):
+                    continue
+                failures = resp.get( 'data', None ) if resp is not False else None
+                if type( failures ) is not list:
                     isSuccess = resp
+                    continue
+                for failure in failures:
+                    uid = failure.get( 'data', {} ).get( 'uid', None )
+                    if uid in unknown and 'actor not found' == failure[ 'status' ][ 'error' ]:
+                        nNotFound[ uid ] = nNotFound.get( uid, 0 ) + 1
+                    else:
+                        isSuccess = resp
+
+            for uid in unknown:
+                if nNotFound.get( uid, 0 ) == len( self._nodes ):
+                    isSuccess = errorMessage( 'actor not found', { 'uid' : uid } )
 
         return isSuccess
 
@@ -117,7 +117,7 @@ class BeachShell ( cmd.Cmd ):
 
         category = arguments.category
 
-        resp = self.beach.getDirectory()
+        resp = self.beach.getDirectory( realm = self.realm, category = category )
 
         wanted = False
 
@@ -136,8 +136,13 @@ class BeachShell ( cmd.Cmd ):
 
         parser.add_argument( '--confirm',
                              action = 'store_true',
-                             help = 'This command flushes ALL ACTORS from the cluster REGARDLESS of the realm. '
-                                    'Add this flag to confirm you understand this.' )
+                             help = 'This command flushes ALL ACTORS from the cluster REGARDLESS of the realm '
+                                    'unless --realm is given. Add this flag to confirm you understand this.' )
+        parser.add_argument( '-r', '--realm',
+                             type = str,
+                             dest = 'realm',
+                             default = None,
+                             help = 'only flush the actors of this realm.' )
         arguments = self.parse( parser, s )
 
         if arguments is None:
@@ -145,7 +150,7 @@ class BeachShell ( cmd.Cmd ):
 
         resp = 'Please confirm ( see command help )'
         if arguments.confirm:
-            resp = self.beach.flush()
+            resp = self.beach.flush( realm = arguments.realm )
 
         self.printOut( resp )
 
@@ -173,12 +178,20 @@ class BeachShell ( cmd.Cmd ):
                              dest = 'strat_hint',
                              default = None,
                              help = 'hint used as part of some strategies.' )
+        parser.add_argument( '-N', '--count',
+                             type = int,
+                             dest = 'count',
+                             default = 1,
+                             help = 'the number of actors to spawn.' )
         arguments = self.parse( parser, s )
 
         if arguments is None:
             return
 
-        resp = self.beach.addActor( arguments.name, arguments.category, arguments.strategy, arguments.strat_hint )
+        if 1 == arguments.count:
+            resp = self.beach.addActor( arguments.name, arguments.category, arguments.strategy, arguments.strat_hint )
+        else:
+            resp = self.beach.addActors( arguments.name, arguments.category, arguments.count, arguments.strategy, arguments.strat_hint )
 
         self.printOut( resp )
 
@@ -0,0 +1,202 @@
+# Copyright (C) 2015  refractionPOINT
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+'''Template process used by the HostManager to fork new ActorHost instances. The
+template imports beach and its dependencies (and any module listed in fork_server_preload)
+once, so instances start faster and share those pages copy-on-write.
+'''
+
+import sys
+import os
+import signal
+import json
+import errno
+import traceback
+import gevent
+import gevent.lock
+import gevent.subprocess
+
+class _ForkedProcess ( object ):
+    '''Handle to an instance forked by the template, it mimics the parts of
+       subprocess.Popen used by the HostManager.'''
+
+    def __init__( self, server, pid ):
+        self._server = server
+        self.pid = pid
+        self.returncode = None
+
+    def send_signal( self, sig ):
+        try:
+            os.kill( self.pid, sig )
+        except OSError:
+            pass
+
+    def kill( self ):
+        self.send_signal( signal.SIGKILL )
+
+    def poll( self ):
+        if self.returncode is None:
+            self.returncode = self._server.poll( self.pid )
+        return self.returncode
+
+    def wait( self ):
+        while self.poll() is None:
+            gevent.sleep( 0.1 )
+        return self.returncode
+
+class _ForkServer ( object ):
+    '''Client side of the template process, requests go over its stdin / stdout
+       as one json object per line.'''
+
+    def __init__( self, configFilePath ):
+        self._configFilePath = configFilePath
+        self._lock = gevent.lock.Semaphore()
+        self._proc = None
+
+    def _start( self ):
+        self._proc = gevent.subprocess.Popen( [ 'python',
+                                                os.path.abspath( __file__ ),
+                                                self._configFilePath ],
+                                              stdin = gevent.subprocess.PIPE,
+                                              stdout = gevent.subprocess.PIPE )
+
+    def _request( self, data ):
+        with self._lock:
+            for attempt in range( 2 ):
+                if self._proc is None or self._proc.poll() is not None:
+                    self._start()
+                try:
+                    self._proc.stdin.write( json.dumps( data ) + '\n' )
+                    self._proc.stdin.flush()
+                    resp = self._proc.stdout.readline()
+                except IOError:
+                    resp = ''
+                if resp:
+                    return json.loads( resp )
+                # The template died, it gets replaced on the next attempt
+                self._proc = None
+            return None
+
+    def spawn( self, instanceId ):
+        resp = self._request( { 'op' : 'spawn', 'id' : instanceId } )
+        if resp is None or 'pid' not in resp:
+            return None
+        return _ForkedProcess( self, resp[ 'pid' ] )
+
+    def poll( self, pid ):
+        resp = self._request( { 'op' : 'poll', 'pid' : pid } )
+        if resp is not None and resp.get( 'known', False ):
+            return resp[ 'returncode' ]
+
+        # If a new template is running it never knew about this process
+        # so we fall back on checking if the pid is still around.
+        try:
+            os.kill( pid, 0 )
+        except OSError, e:
+            if errno.ESRCH == e.errno:
+                return -1
+        return None
+
+    def close( self ):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+        self._proc = None
+
+def _runInstance( configFilePath, instanceId ):
+    # The instance must not keep the requests pipe from the HostManager open.
+    devNull = os.open( os.devnull, os.O_RDWR )
+    os.dup2( devNull, 0 )
+    os.close( devNull )
+
+    gevent.reinit()
+
+    from beach.actorhost import ActorHost
+    ActorHost( configFilePath, instanceId )
+
+def _reapChildren( children ):
+    # Every exited child is reaped right away so none is left a zombie, even
+    # if the HostManager never asks about it.
+    while True:
+        try:
+            pid, status = os.waitpid( -1, os.WNOHANG )
+        except OSError:
+            break
+        if 0 == pid:
+            break
+        if pid in children:
+            if os.WIFSIGNALED( status ):
+                children[ pid ] = -os.WTERMSIG( status )
+            else:
+                children[ pid ] = os.WEXITSTATUS( status )
+
+def _serve( configFilePath ):
+    import yaml
+    import zmq.green
+    import beach.utils
+    import beach.actor
+    import beach.actorhost
+
+    with open( configFilePath, 'r' ) as f:
+        configFile = yaml.load( f )
+
+    for moduleName in configFile.get( 'fork_server_preload', None ) or []:
+        try:
+            __import__( moduleName )
+        except:
+            sys.stderr.write( "Fork server could not preload %s\n" % moduleName )
+
+    # Only the replies go to the HostManager, anything else printed goes to stderr.
+    requests = sys.stdin
+    replies = os.fdopen( os.dup( 1 ), 'w' )
+    os.dup2( 2, 1 )
+    children = {}
+
+    while True:
+        line = requests.readline()
+        if not line:
+            break
+        data = json.loads( line )
+        resp = {}
+        _reapChildren( children )
+
+        if 'spawn' == data[ 'op' ]:
+            pid = os.fork()
+            if 0 == pid:
+                exitCode = 0
+                try:
+                    replies.close()
+                    _runInstance( configFilePath, data[ 'id' ] )
+                except:
+                    traceback.print_exc()
+                    exitCode = 1
+                os._exit( exitCode )
+            children[ pid ] = None
+            resp[ 'pid' ] = pid
+        elif 'poll' == data[ 'op' ]:
+            pid = data[ 'pid' ]
+            if pid in children:
+                resp[ 'known' ] = True
+                resp[ 'returncode' ] = children[ pid ]
+                if resp[ 'returncode' ] is not None:
+                    del( children[ pid ] )
+            else:
+                resp[ 'known' ] = False
+
+        replies.write( json.dumps( resp ) + '\n' )
+        replies.flush()
+
+if __name__ == '__main__':
+    _serve( sys.argv[ 1 ] )
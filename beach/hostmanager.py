@@ -24,12 +24,16 @@ import signal
 import gevent
 import gevent.event
 import gevent.pool
+import gevent.lock
 import yaml
 import multiprocessing
 from beach.utils import *
 from beach.utils import _getIpv4ForIface
 from beach.utils import _ZMREQ
 from beach.utils import _ZMREP
+from beach.utils import _DirectoryMirror
+from beach.utils import _makePrivateDirectory
+from beach.forkserver import _ForkServer
 import time
 import uuid
 import random
@@ -39,6 +43,13 @@ import subprocess
 import psutil
 import collections
 import uuid
+import bisect
+import traceback
+import hashlib
+import json
+import base64
+import shutil
+import glob
 
 timeToStopEvent = gevent.event.Event()
 
@@ -47,6 +58,10 @@ def _stop():
     timeToStopEvent.set()
 
 class HostManager ( object ):
+
+    # These requests are served by their own handlers so keepalives and directory
+    # gossip between nodes are never stuck behind slow requests like start_actor.
+    _CONTROL_OPS = ( 'keepalive', 'get_nodes', 'get_dir_sync', 'push_dir_sync', 'host_info' )
     
     # The actorList is a list( actorNames, configFile )
     def __init__( self, configFile, iface = None ):
@@ -64,7 +79,11 @@ class HostManager ( object ):
         self.configFilePath = os.path.abspath( configFile )
         self.configFile = None
         self.directory = {}
+        self.dirGenerations = {}
+        self.dirEpoch = uuid.uuid4().hex[ : 8 ]
         self.tombstones = {}
+        self.tombstoneLog = []
+        self.newTombstones = []
         self.actorInfo = {}
         self.ports_available = Set()
         self.nProcesses = 0
@@ -81,8 +100,14 @@ class HostManager ( object ):
         self.peer_keepalive_seconds = 0
         self.instance_keepalive_seconds = 0
         self.tombstone_culling_seconds = 0
+        self.metrics_sample_seconds = 0
+        self.hostMetrics = None
+        self.instanceProcs = {}
+        self.lastNetCounters = None
         self.isActorChanged = gevent.event.Event()
         self.isInstanceChanged = gevent.event.Event()
+        self.isDirChanged = gevent.event.Event()
+        self.dirMirror = None
 
         # Load default configs
         with open( self.configFilePath, 'r' ) as f:
@@ -115,8 +140,19 @@ class HostManager ( object ):
                                                          'ipc:///tmp/py_beach_directory_port' ),
                                     isBind = True )
         
+        mirrorPath = self.configFile.get( 'directory_mirror', '/tmp/py_beach_directory_mirror' )
+        if mirrorPath:
+            try:
+                self.dirMirror = _DirectoryMirror( mirrorPath, isWriter = True )
+                self._log( "Publishing directory mirror to %s" % mirrorPath )
+            except OSError as e:
+                self._logCritical( "Not publishing directory mirror to %s: %s" % ( mirrorPath, e ) )
+
         self.opsPort = self.configFile.get( 'ops_port', 4999 )
-        self.opsSocket = _ZMREP( 'tcp://%s:%d' % ( self.ifaceIp4, self.opsPort ), isBind = True )
+        self.opsSocket = _ZMREP( 'tcp://%s:%d' % ( self.ifaceIp4, self.opsPort ),
+                                 isBind = True,
+                                 lanes = { 'control' : self._CONTROL_OPS } )
+        self.opsConcurrency = self.configFile.get( 'ops_concurrency', 10 )
         self._log( "Listening for ops on %s:%d" % ( self.ifaceIp4, self.opsPort ) )
         
         self.port_range = ( self.configFile.get( 'port_range_start', 5000 ), self.configFile.get( 'port_range_end', 6000 ) )
@@ -128,6 +164,43 @@ class HostManager ( object ):
         self.tombstone_culling_seconds = self.configFile.get( 'tombstone_culling_seconds', 3600 )
         
         self.instance_strategy = self.configFile.get( 'instance_strategy', 'random' )
+        self.instance_spread_categories = self.configFile.get( 'instance_spread_categories', False )
+
+        # Instances can be pinned to a single core, 'core', or to the cores of a NUMA node, 'numa'
+        self.instance_cpu_affinity = self.configFile.get( 'instance_cpu_affinity', None )
+        self.numaNodes = None
+        if self.instance_cpu_affinity:
+            if not hasattr( psutil.Process, 'cpu_affinity' ):
+                self._logCritical( "Cpu affinity is not supported on this platform, not pinning instances" )
+                self.instance_cpu_affinity = None
+            else:
+                self.numaNodes = self._getNumaNodes()
+                self._log( "Pinning instances per %s over NUMA nodes %s" % ( self.instance_cpu_affinity, str( self.numaNodes ) ) )
+        self.nextInstance = 0
+        self.isolated_pool_size = self.configFile.get( 'isolated_pool_size', 0 )
+
+        # When a code source node is set, realms are pulled from it as content addressed
+        # bundles kept on local disk instead of being read from code_directory.
+        self.codeDirectory = os.path.abspath( self.configFile.get( 'code_directory', './' ) )
+        self.codeHashes = {}
+        self.codeBundles = {}
+        self.codeBundleLocks = {}
+        self.codeSourceSocket = None
+        self.code_bundle_directory = self.configFile.get( 'code_bundle_directory', '/tmp/py_beach_code_bundles' )
+        self.code_sync_seconds = self.configFile.get( 'code_sync_seconds', 60 )
+        codeSource = self.configFile.get( 'code_source_node', None )
+        if codeSource is not None and codeSource != self.ifaceIp4:
+            self.codeSourceSocket = _ZMREQ( 'tcp://%s:%d' % ( codeSource, self.opsPort ), isBind = False )
+            self._log( "Pulling code bundles from %s" % codeSource )
+
+        self.forkServer = None
+        self.instance_launcher = self.configFile.get( 'instance_launcher', 'subprocess' )
+        if 'fork_server' == self.instance_launcher:
+            self.forkServer = _ForkServer( self.configFilePath )
+        self._log( "Launching instances with %s" % self.instance_launcher )
+
+        self.metrics_sample_seconds = self.configFile.get( 'metrics_sample_seconds', 5 )
+        self.hostMetrics = collections.deque( maxlen = self.configFile.get( 'metrics_history_size', 60 ) )
         
         # Bootstrap the seeds
         for s in self.seedNodes:
@@ -135,17 +208,24 @@ class HostManager ( object ):
         
         # Start services
         self._log( "Starting services" )
+        gevent.spawn( self._svc_sampleMetrics )
         gevent.spawn( self._svc_directory_requests )
         gevent.spawn( self._svc_instance_keepalive )
         gevent.spawn( self._svc_host_keepalive )
         gevent.spawn( self._svc_directory_sync )
         gevent.spawn( self._svc_cullTombstones )
-        gevent.spawn( self._svc_receiveOpsTasks )
+        for n in range( self.opsConcurrency ):
+            gevent.spawn( self._svc_receiveOpsTasks )
+        for n in range( 2 ):
+            gevent.spawn( self._svc_receiveOpsTasks, 'control' )
         gevent.spawn( self._svc_pushDirChanges )
+        if self.dirMirror is not None:
+            gevent.spawn( self._svc_publishDirMirror )
         
         # Start the instances
         for n in range( self.nProcesses ):
             self._startInstance( isIsolated = False )
+        self._refillWarmPool()
         
         # Wait to be signaled to exit
         self._log( "Up and running" )
@@ -154,26 +234,52 @@ class HostManager ( object ):
         # Any teardown required
         for proc in self.processes:
             self._sendQuitToInstance( proc )
+        if self.forkServer is not None:
+            self.forkServer.close()
         
         self._log( "Exiting." )
 
     def _sendQuitToInstance( self, instance ):
         if instance[ 'p' ] is not None:
             instance[ 'p' ].send_signal( signal.SIGQUIT )
-            errorCode = instance[ 'p' ].wait()
+            # Poll rather than wait() so the other ops keep being served
+            while instance[ 'p' ].poll() is None:
+                gevent.sleep( 0.1 )
+            errorCode = instance[ 'p' ].returncode
             if 0 != errorCode:
                 self._logCritical( 'actor host exited with error code: %d' % errorCode )
 
-    def _startInstance( self, isIsolated = False ):
+    def _reapProcess( self, proc ):
+        # Polled rather than wait() so the other ops keep being served
+        while proc.poll() is None:
+            gevent.sleep( 0.1 )
+
+    def _startInstance( self, isIsolated = False, isWarm = False ):
         instanceId = str( uuid.uuid4() )
         procSocket = _ZMREQ( 'ipc:///tmp/py_beach_instance_%s' % instanceId, isBind = False )
-        instance = { 'socket' : procSocket, 'p' : None, 'isolated' : isIsolated, 'id' : instanceId }
+        instance = { 'socket' : procSocket,
+                     'p' : None,
+                     'isolated' : isIsolated,
+                     'warm' : isWarm,
+                     'ready' : False,
+                     'cpus' : None,
+                     'id' : instanceId }
         self.processes.append( instance )
         self._log( "Managing instance at: %s" % ( 'ipc:///tmp/py_beach_instance_%s' % instanceId, ) )
         return instance
 
+    def _refillWarmPool( self ):
+        # Warm instances are isolated instances started ahead of time and waiting
+        # for an actor so isolated actors don't have to wait for a new process to boot.
+        nWarm = len( [ x for x in self.processes if x[ 'warm' ] ] )
+        if nWarm < self.isolated_pool_size:
+            for n in range( self.isolated_pool_size - nWarm ):
+                self._startInstance( isIsolated = True, isWarm = True )
+            self.isInstanceChanged.set()
+
     def _removeInstanceIfIsolated( self, instance ):
-        if instance[ 'isolated' ]:
+        # Concurrent requests may both be done with the same isolated instance
+        if instance[ 'isolated' ] and instance in self.processes:
             # Isolated instances only have one Actor loaded
             # so this means we can remove this instance
             self._log( "Removing isolated host instance: %s" % instance[ 'id' ] )
@@ -182,18 +288,19 @@ class HostManager ( object ):
 
     def _connectToNode( self, ip ):
         nodeSocket = _ZMREQ( 'tcp://%s:%d' % ( ip, self.opsPort ), isBind = False )
-        self.nodes[ ip ] = { 'socket' : nodeSocket, 'last_seen' : None }
+        self.nodes[ ip ] = { 'socket' : nodeSocket, 'last_seen' : None, 'last_sync' : None }
 
     def _removeUidFromDirectory( self, uid ):
         isFound = False
-        for r in self.directory.values():
-            for c in r.values():
+        for realm, r in self.directory.items():
+            for category, c in r.items():
                 if uid in c:
                     del( c[ uid ] )
+                    self._bumpDirGeneration( realm, category )
                     isFound = True
                     break
             if isFound:
-                self.tombstones[ uid ] = int( time.time() )
+                self._addTombstone( uid )
                 break
 
         if uid in self.actorInfo:
@@ -203,6 +310,24 @@ class HostManager ( object ):
 
         return isFound
 
+    def _addTombstone( self, uid ):
+        ts = int( time.time() )
+        # The log is kept in timestamp order, even if the clock steps back, so
+        # culling only looks at its head and syncs bisect it.
+        if 0 != len( self.tombstoneLog ) and self.tombstoneLog[ -1 ][ 0 ] > ts:
+            ts = self.tombstoneLog[ -1 ][ 0 ]
+        self.tombstones[ uid ] = ts
+        self.tombstoneLog.append( ( ts, uid ) )
+        self.newTombstones.append( uid )
+
+    def _getTombstonesSince( self, since ):
+        # Tombstones are only exchanged as a list of uids, the timestamps
+        # are local to each node and only used for culling.
+        if since is None:
+            return self.tombstones.keys()
+        start = bisect.bisect_left( self.tombstoneLog, ( since, ) )
+        return [ uid for ts, uid in self.tombstoneLog[ start : ] ]
+
     def _removeInstanceActorsFromDirectory( self, instance ):
         for uid, actor in self.actorInfo.items():
             if actor[ 'instance' ] == instance:
@@ -217,184 +342,641 @@ class HostManager ( object ):
         
         return port
     
-    def _getInstanceForActor( self, uid, actorName, realm, isIsolated = False ):
+    def _getActorsPerInstance( self, realm = None, category = None ):
+        nActors = {}
+        for actor in self.actorInfo.values():
+            if 'instance' not in actor:
+                continue
+            if category is not None and ( actor.get( 'cat', None ) != category or
+                                          actor.get( 'realm', None ) != realm ):
+                continue
+            instanceId = actor[ 'instance' ][ 'id' ]
+            nActors[ instanceId ] = nActors.get( instanceId, 0 ) + 1
+        return nActors
+
+    def _getInstanceForActor( self, uid, actorName, realm, isIsolated = False, category = None ):
         instance = None
 
         if isIsolated:
             self.nProcesses += 1
-            instance = self._startInstance( isIsolated = True )
-            self.isInstanceChanged.set()
-        elif self.instance_strategy == 'random':
-            instance = random.choice( [ x for x in self.processes if x[ 'isolated' ] is False ] )
+            warm = [ x for x in self.processes if x[ 'warm' ] and x[ 'p' ] is not None ]
+            if 0 != len( warm ):
+                # Prefer an instance that is done booting
+                instance = max( warm, key = lambda x: x[ 'ready' ] )
+                instance[ 'warm' ] = False
+                self._log( "Using warm instance %s for isolated actor" % instance[ 'id' ] )
+            else:
+                instance = self._startInstance( isIsolated = True )
+                self.isInstanceChanged.set()
+            self._refillWarmPool()
+        else:
+            shared = [ x for x in self.processes if x[ 'isolated' ] is False ]
+            candidates = shared
+
+            if self.instance_spread_categories and category is not None:
+                # Replicas of a category go to the instances that have the fewest of
+                # them so they end up using different cores.
+                nSame = self._getActorsPerInstance( realm, category )
+                fewest = min( nSame.get( x[ 'id' ], 0 ) for x in shared )
+                candidates = [ x for x in shared if nSame.get( x[ 'id' ], 0 ) == fewest ]
+
+            if self.instance_strategy == 'round_robin':
+                for n in range( len( shared ) ):
+                    instance = shared[ ( self.nextInstance + n ) % len( shared ) ]
+                    if instance in candidates:
+                        self.nextInstance += n + 1
+                        break
+            elif self.instance_strategy in ( 'least_actors', 'least_cpu' ):
+                nActors = self._getActorsPerInstance()
+                load = lambda x: nActors.get( x[ 'id' ], 0 )
+                if self.instance_strategy == 'least_cpu' and 0 != len( self.hostMetrics ):
+                    usage = self.hostMetrics[ -1 ][ 'instances' ]
+                    # Actors placed since the last sample are assumed to cost as much as the
+                    # average actor in the instance at that time, so a burst of new actors
+                    # doesn't all go to the instance that was the least busy.
+                    def key( x ):
+                        sample = usage.get( x[ 'id' ], {} )
+                        return ( sample.get( 'cpu', 0 ) * load( x ) / max( sample.get( 'n_actors', 0 ), 1 ),
+                                 load( x ) )
+                else:
+                    key = load
+                lowest = min( key( x ) for x in candidates )
+                instance = random.choice( [ x for x in candidates if key( x ) == lowest ] )
+            else:
+                instance = random.choice( candidates )
         
         if instance is not None:
             self.actorInfo.setdefault( uid, {} )[ 'instance' ] = instance
         
         return instance
 
-    def _updateDirectoryWith( self, curDir, newDir ):
-        for k, v in newDir.iteritems():
-            if isinstance( v, collections.Mapping ):
-                r = self._updateDirectoryWith( curDir.get( k, {} ), v )
-                curDir[k] = r
+    def _prepareActor( self, actorName, category, realm, parameters, isIsolated ):
+        uid = str( uuid.uuid4() )
+        port = self._getAvailablePortForUid( uid )
+        instance = self._getInstanceForActor( uid, actorName, realm, isIsolated, category )
+        info = self.actorInfo.setdefault( uid, {} )
+        info[ 'realm' ] = realm
+        info[ 'cat' ] = category
+        spec = { 'actor_name' : actorName,
+                 'realm' : realm,
+                 'uid' : uid,
+                 'ip' : self.ifaceIp4,
+                 'port' : port,
+                 'parameters' : parameters,
+                 'isolated' : isIsolated }
+        codeDirectory = self._getCodeDirectoryFor( realm )
+        if codeDirectory is not None:
+            spec[ 'code_directory' ] = codeDirectory
+        return ( spec, instance )
+
+    def _getRealmDirectory( self, realm ):
+        # The realm comes from the request, it must name a directory right under the code_directory
+        if ( not isinstance( realm, basestring ) or
+             '' == realm or
+             os.path.isabs( realm ) or
+             os.sep in realm or
+             ( os.altsep is not None and os.altsep in realm ) or
+             '..' in realm ):
+            return None
+        codeDir = os.path.realpath( self.codeDirectory )
+        realmDir = os.path.realpath( os.path.join( codeDir, realm ) )
+        if os.path.dirname( realmDir ) != codeDir:
+            return None
+        return realmDir
+
+    @classmethod
+    def _isPathUnder( cls, path, directory ):
+        return os.path.realpath( path ).startswith( os.path.realpath( directory ) + os.sep )
+
+    def _getCodeManifest( self, realm ):
+        realmDir = self._getRealmDirectory( realm )
+        if realmDir is None:
+            return None
+        files = {}
+        for root, dirs, fileNames in os.walk( realmDir ):
+            for fileName in fileNames:
+                if fileName.endswith( ( '.pyc', '.pyo' ) ):
+                    continue
+                path = os.path.join( root, fileName )
+                if not self._isPathUnder( path, realmDir ):
+                    # Symlinks out of the realm are not part of its code
+                    continue
+                try:
+                    info = os.stat( path )
+                except OSError:
+                    continue
+                # Files are only hashed again if they changed since the last manifest
+                known = self.codeHashes.get( path, None )
+                if known is None or known[ 0 ] != info.st_mtime or known[ 1 ] != info.st_size:
+                    with open( path, 'rb' ) as f:
+                        known = ( info.st_mtime, info.st_size, hashlib.sha1( f.read() ).hexdigest() )
+                    self.codeHashes[ path ] = known
+                files[ os.path.relpath( path, realmDir ) ] = known[ 2 ]
+        version = hashlib.sha1( json.dumps( [ realm, sorted( files.items() ) ] ) ).hexdigest()
+        return { 'realm' : realm, 'version' : version, 'files' : files }
+
+    def _getCodeFile( self, realm, relPath ):
+        realmDir = self._getRealmDirectory( realm )
+        if realmDir is None or not isinstance( relPath, basestring ):
+            return None
+        path = os.path.join( realmDir, relPath )
+        if not self._isPathUnder( path, realmDir ) or not os.path.isfile( path ):
+            return None
+        with open( path, 'rb' ) as f:
+            return f.read()
+
+    def _getCodeDirectoryFor( self, realm ):
+        '''Returns the local directory to load the code of the realm from, or None
+           if it should come from the code_directory.'''
+        if self.codeSourceSocket is None:
+            return None
+        # A spawn storm only triggers a single sync of the realm
+        with self.codeBundleLocks.setdefault( realm, gevent.lock.Semaphore() ):
+            bundle = self.codeBundles.get( realm, None )
+            if bundle is None or bundle[ 'synced' ] + self.code_sync_seconds < time.time():
+                newBundle = self._syncCodeBundle( realm )
+                if newBundle is not None:
+                    bundle = newBundle
+                    self.codeBundles[ realm ] = bundle
+                elif bundle is not None:
+                    # Keep using the last bundle we have until the source is back
+                    bundle[ 'synced' ] = time.time()
+        if bundle is None:
+            return None
+        return bundle[ 'root' ]
+
+    def _syncCodeBundle( self, realm ):
+        # Bundles live in versions/<version>/<realm>/ and are made of hard links to
+        # objects/<sha1>, so only the files we never saw before get fetched.
+        resp = self.codeSourceSocket.request( { 'req' : 'get_code_manifest', 'realm' : realm }, timeout = 10 )
+        if not isMessageSuccess( resp ):
+            self._logCritical( "Could not get code manifest for realm %s: %s" % ( realm, str( resp ) ) )
+            return None
+
+        # Names from the source end up in paths, they must not point out of the bundle
+        if not self._isSha1( resp.get( 'version', None ) ):
+            self._logCritical( "Invalid code manifest for realm %s" % realm )
+            return None
+        for relPath, fileHash in resp.get( 'files', {} ).iteritems():
+            if ( not self._isSha1( fileHash ) or
+                 os.path.isabs( relPath ) or
+                 '..' in relPath.split( '/' ) or
+                 '..' in relPath.split( os.sep ) ):
+                self._logCritical( "Invalid code manifest for realm %s: %s" % ( realm, relPath ) )
+                return None
+
+        if not _makePrivateDirectory( self.code_bundle_directory ):
+            self._logCritical( "Code bundle directory %s must be owned by us with mode 0700" % self.code_bundle_directory )
+            return None
+
+        objectsDir = os.path.join( self.code_bundle_directory, 'objects' )
+        root = os.path.join( self.code_bundle_directory, 'versions', resp[ 'version' ] )
+        if not os.path.isdir( root ):
+            if not os.path.isdir( objectsDir ):
+                os.makedirs( objectsDir )
+            for relPath, fileHash in resp[ 'files' ].iteritems():
+                objectPath = os.path.join( objectsDir, fileHash )
+                if os.path.isfile( objectPath ):
+                    # Only trusted if it is still what its name says
+                    with open( objectPath, 'rb' ) as f:
+                        if hashlib.sha1( f.read() ).hexdigest() == fileHash:
+                            continue
+                fileResp = self.codeSourceSocket.request( { 'req' : 'get_code_file',
+                                                            'realm' : realm,
+                                                            'path' : relPath }, timeout = 30 )
+                if not isMessageSuccess( fileResp ):
+                    self._logCritical( "Could not get code file %s/%s: %s" % ( realm, relPath, str( fileResp ) ) )
+                    return None
+                content = base64.b64decode( fileResp[ 'content' ] )
+                if hashlib.sha1( content ).hexdigest() != fileHash:
+                    # The file changed since the manifest, the next sync will catch up
+                    self._logCritical( "Code file %s/%s changed during sync" % ( realm, relPath ) )
+                    return None
+                tmpPath = '%s.%s.tmp' % ( objectPath, uuid.uuid4().hex )
+                with open( tmpPath, 'wb' ) as f:
+                    f.write( content )
+                os.rename( tmpPath, objectPath )
+
+            tmpRoot = '%s.%s.tmp' % ( root, uuid.uuid4().hex )
+            for relPath, fileHash in resp[ 'files' ].iteritems():
+                dest = os.path.join( tmpRoot, realm, relPath )
+                if not os.path.isdir( os.path.dirname( dest ) ):
+                    os.makedirs( os.path.dirname( dest ) )
+                try:
+                    os.link( os.path.join( objectsDir, fileHash ), dest )
+                except OSError:
+                    shutil.copyfile( os.path.join( objectsDir, fileHash ), dest )
+            try:
+                os.rename( tmpRoot, root )
+            except OSError:
+                # Another HostManager sharing the bundle directory got there first
+                shutil.rmtree( tmpRoot, ignore_errors = True )
+            self._log( "New code bundle %s for realm %s" % ( resp[ 'version' ], realm ) )
+
+        return { 'version' : resp[ 'version' ], 'root' : root, 'synced' : time.time() }
+
+    @classmethod
+    def _isSha1( cls, value ):
+        return ( isinstance( value, basestring ) and
+                 40 == len( value ) and
+                 all( c in '0123456789abcdef' for c in value ) )
+
+    def _registerStartedActor( self, spec, category, resp ):
+        uid = spec[ 'uid' ]
+        if isMessageSuccess( resp ):
+            self._log( "New actor loaded (isolation = %s), adding to directory" % spec[ 'isolated' ] )
+            self.directory.setdefault( spec[ 'realm' ],
+                                       {} ).setdefault( category,
+                                                        {} )[ uid ] = 'tcp://%s:%d' % ( self.ifaceIp4,
+                                                                                        spec[ 'port' ] )
+            self._bumpDirGeneration( spec[ 'realm' ], category )
+            self.isActorChanged.set()
+            resp[ 'uid' ] = uid
+        else:
+            self._removeUidFromDirectory( uid )
+
+    def _startActorsInInstance( self, instance, category, specs ):
+        # The instance loads the whole batch from a single request, we give
+        # it a bit more time the larger the batch is.
+        resp = instance[ 'socket' ].request( { 'req' : 'start_actors', 'actors' : specs },
+                                             timeout = 10 + len( specs ) )
+        results = []
+        for i, spec in enumerate( specs ):
+            if isMessageSuccess( resp ):
+                result = resp[ 'results' ][ i ]
+            elif resp is False:
+                result = errorMessage( 'timeout' )
             else:
-                curDir[k] = newDir[k]
+                result = resp
+            self._registerStartedActor( spec, category, result )
+            results.append( result )
+        return results
+
+    def _stopActors( self, uids ):
+        failed = []
+        perInstance = {}
+        for uid in uids:
+            instance = self.actorInfo.get( uid, {} ).get( 'instance', None )
+            if instance is None:
+                failed.append( errorMessage( 'actor not found', { 'uid' : uid } ) )
+            else:
+                perInstance.setdefault( instance[ 'id' ], ( instance, [] ) )[ 1 ].append( uid )
+
+        # All the instances stop their actors concurrently
+        jobs = [ gevent.spawn( self._stopActorsInInstance, instance, instanceUids )
+                 for instance, instanceUids in perInstance.values() ]
+        gevent.joinall( jobs )
+
+        for job in jobs:
+            if job.successful():
+                failed += job.value
+            else:
+                failed.append( errorMessage( 'exception', { 'st' : str( job.exception ) } ) )
+
+        return failed
+
+    def _stopActorsInInstance( self, instance, uids ):
+        failed = []
+        # The instance waits up to 10 seconds for its actors to stop and up to
+        # 10 more to kill the ones that did not.
+        resp = instance[ 'socket' ].request( { 'req' : 'kill_actors', 'uids' : uids }, timeout = 25 )
+        for uid in uids:
+            if isMessageSuccess( resp ):
+                result = resp[ 'results' ].get( uid, errorMessage( 'actor not found' ) )
+            elif resp is False:
+                result = errorMessage( 'timeout' )
+            else:
+                # Each uid gets its own copy since the uid is added to it below
+                status = resp.get( 'status', {} ) if type( resp ) is dict else {}
+                data = resp.get( 'data', None ) if type( resp ) is dict else None
+                result = errorMessage( status.get( 'error', 'error stopping actors' ),
+                                       dict( data ) if type( data ) is dict else {} )
+            if not isMessageSuccess( result ):
+                result.setdefault( 'data', {} )[ 'uid' ] = uid
+                failed.append( result )
+            elif not self._removeUidFromDirectory( uid ):
+                failed.append( errorMessage( 'error removing actor from directory after stop', { 'uid' : uid } ) )
+            else:
+                self.isActorChanged.set()
+
+        self._removeInstanceIfIsolated( instance )
+
+        return failed
+
+    def _updateDirectoryWith( self, curDir, newDir ):
+        for realm, categories in newDir.iteritems():
+            curRealm = curDir.setdefault( realm, {} )
+            for category, endpoints in categories.iteritems():
+                curCategory = curRealm.setdefault( category, {} )
+                isChanged = False
+                for uid, endpoint in endpoints.iteritems():
+                    # Don't resurrect actors we already know are gone
+                    if uid not in self.tombstones and curCategory.get( uid, None ) != endpoint:
+                        curCategory[ uid ] = endpoint
+                        isChanged = True
+                if isChanged:
+                    self._bumpDirGeneration( realm, category )
         return curDir
 
+    def _bumpDirGeneration( self, realm, category ):
+        realmGens = self.dirGenerations.setdefault( realm, {} )
+        realmGens[ category ] = realmGens.get( category, 0 ) + 1
+        self.isDirChanged.set()
+
+    def _getDirGeneration( self, realm, category ):
+        # Generations are only meaningful to the node that issued them, the epoch
+        # makes sure a generation is never matched against another node or against
+        # a previous run of this node.
+        return '%s-%d' % ( self.dirEpoch, self.dirGenerations.get( realm, {} ).get( category, 0 ) )
+
     def _getDirectoryEntriesFor( self, realm, category ):
         return self.directory.get( realm, {} ).get( category, {} )
-    
+
+    def _getDirectoryReply( self, data ):
+        realm = data.get( 'realm', 'global' )
+        if 'cat' not in data:
+            return errorMessage( 'no category specified' )
+        category = data[ 'cat' ]
+        gen = self._getDirGeneration( realm, category )
+        if data.get( 'gen', None ) == gen:
+            return successMessage( data = { 'not_modified' : True, 'gen' : gen } )
+        return successMessage( data = { 'endpoints' : self._getDirectoryEntriesFor( realm, category ),
+                                        'gen' : gen } )
+
+    def _getFullDirectoryReply( self, data ):
+        realmFilter = data.get( 'realm', None )
+        catFilter = data.get( 'cat', None )
+        prefixFilter = data.get( 'cat_prefix', None )
+        nodeFilter = data.get( 'node', None )
+        pageSize = data.get( 'page_size', None )
+        if pageSize is not None and ( type( pageSize ) not in ( int, long ) or pageSize < 1 ):
+            return errorMessage( 'page_size must be at least 1' )
+        # The page token is the [ realm, category, uid ] of the last entry of the
+        # previous page, it stays valid even if the directory changes between pages.
+        after = data.get( 'after', None )
+        if after is not None:
+            after = tuple( after )
+
+        if ( realmFilter is None and catFilter is None and prefixFilter is None and
+             nodeFilter is None and pageSize is None ):
+            return successMessage( { 'realms' : self.directory } )
+
+        if nodeFilter is not None:
+            nodeFilter = 'tcp://%s:' % nodeFilter
+
+        if realmFilter is not None:
+            realms = ( realmFilter, ) if realmFilter in self.directory else ()
+        else:
+            realms = sorted( self.directory.keys() )
+
+        wanted = {}
+        nEntries = 0
+        nextToken = None
+        for realm in realms:
+            categories = self.directory[ realm ]
+            if catFilter is not None:
+                catNames = ( catFilter, ) if catFilter in categories else ()
+            else:
+                catNames = sorted( categories.keys() )
+            for category in catNames:
+                if prefixFilter is not None and not category.startswith( prefixFilter ):
+                    continue
+                if after is not None and ( realm, category ) < after[ : 2 ]:
+                    continue
+                for uid in sorted( categories[ category ].keys() ):
+                    if after is not None and ( realm, category, uid ) <= after:
+                        continue
+                    endpoint = categories[ category ][ uid ]
+                    if nodeFilter is not None and not endpoint.startswith( nodeFilter ):
+                        continue
+                    if pageSize is not None and nEntries == pageSize:
+                        nextToken = lastEntry
+                        break
+                    wanted.setdefault( realm, {} ).setdefault( category, {} )[ uid ] = endpoint
+                    lastEntry = ( realm, category, uid )
+                    nEntries += 1
+                if nextToken is not None:
+                    break
+            if nextToken is not None:
+                break
+
+        resp = { 'realms' : wanted }
+        if pageSize is not None:
+            resp[ 'next' ] = nextToken
+        return successMessage( resp )
+
+    def _getDirectoriesReply( self, data ):
+        # Requested either as a list of [ realm, category ] or [ realm, category, gen ]
+        # in 'cats', or as all the categories of a realm starting with 'cat_prefix'.
+        wanted = []
+        if 'cats' in data:
+            for entry in data[ 'cats' ]:
+                wanted.append( ( entry[ 0 ], entry[ 1 ], entry[ 2 ] if 2 < len( entry ) else None ) )
+        elif 'cat_prefix' in data:
+            realm = data.get( 'realm', 'global' )
+            gens = data.get( 'gens', {} )
+            for category in self.directory.get( realm, {} ).keys():
+                if category.startswith( data[ 'cat_prefix' ] ):
+                    wanted.append( ( realm, category, gens.get( category, None ) ) )
+        else:
+            return errorMessage( 'no categories specified' )
+
+        dirs = {}
+        for realm, category, gen in wanted:
+            curGen = self._getDirGeneration( realm, category )
+            if gen == curGen:
+                entry = { 'not_modified' : True, 'gen' : curGen }
+            else:
+                entry = { 'endpoints' : self._getDirectoryEntriesFor( realm, category ), 'gen' : curGen }
+            dirs.setdefault( realm, {} )[ category ] = entry
+
+        return successMessage( data = { 'dirs' : dirs } )
+
     def _svc_cullTombstones( self ):
         while not self.stopEvent.wait( 0 ):
             self._log( "Culling tombstones" )
             currentTime = int( time.time() )
             maxTime = self.tombstone_culling_seconds
-            nextTime = currentTime
-            
-            for uid, ts in self.tombstones.items():
-                if ts < currentTime - maxTime:
-                    del( self.tombstones[ uid ] )
-                elif ts < nextTime:
-                    nextTime = ts
 
-            gevent.sleep( maxTime - ( currentTime - nextTime ) )
+            nExpired = bisect.bisect_left( self.tombstoneLog, ( currentTime - maxTime, ) )
+            for ts, uid in self.tombstoneLog[ : nExpired ]:
+                self.tombstones.pop( uid, None )
+            del( self.tombstoneLog[ : nExpired ] )
+
+            if 0 != len( self.tombstoneLog ):
+                nextWait = self.tombstoneLog[ 0 ][ 0 ] + maxTime - currentTime + 1
+            else:
+                nextWait = maxTime
+
+            gevent.sleep( nextWait )
     
-    def _svc_receiveOpsTasks( self ):
-        z = self.opsSocket.getChild()
+    def _svc_receiveOpsTasks( self, lane = None ):
+        z = self.opsSocket.getChild( lane )
         while not self.stopEvent.wait( 0 ):
             data = z.recv()
             if data is not False and 'req' in data:
-                action = data[ 'req' ]
-                self._log( "Received new ops request: %s" % action )
-                if 'keepalive' == action:
-                    if 'from' in data and data[ 'from' ] not in self.nodes:
-                        self._log( "Discovered new node: %s" % data[ 'from' ] )
-                        self._connectToNode( data[ 'from' ] )
-                    z.send( successMessage() )
-                elif 'start_actor' == action:
-                    if 'actor_name' not in data or 'cat' not in data:
-                        z.send( errorMessage( 'missing information to start actor' ) )
-                    else:
-                        actorName = data[ 'actor_name' ]
-                        category = data[ 'cat' ]
-                        realm = data.get( 'realm', 'global' )
-                        parameters = data.get( 'parameters', {} )
-                        isIsolated = data.get( 'isolated', False )
-                        uid = str( uuid.uuid4() )
-                        port = self._getAvailablePortForUid( uid )
-                        instance = self._getInstanceForActor( uid, actorName, realm, isIsolated )
-                        newMsg = instance[ 'socket' ].request( { 'req' : 'start_actor',
-                                                                 'actor_name' : actorName,
-                                                                 'realm' : realm,
-                                                                 'uid' : uid,
-                                                                 'ip' : self.ifaceIp4,
-                                                                 'port' : port,
-                                                                 'parameters' : parameters,
-                                                                 'isolated' : isIsolated },
-                                                               timeout = 10 )
-                        if isMessageSuccess( newMsg ):
-                            self._log( "New actor loaded (isolation = %s), adding to directory" % isIsolated )
-                            self.directory.setdefault( realm,
-                                                       {} ).setdefault( category,
-                                                                        {} )[ uid ] = 'tcp://%s:%d' % ( self.ifaceIp4,
-                                                                                                        port )
-                            self.isActorChanged.set()
-                        else:
-                            self._removeUidFromDirectory( uid )
-                        z.send( newMsg )
-                elif 'kill_actor' == action:
-                    if 'uid' not in data:
-                        z.send( errorMessage( 'missing information to stop actor' ) )
-                    else:
-                        uids = data[ 'uid' ]
-                        if not isinstance( uids, collections.Iterable ):
-                            uids = ( uids, )
-
-                        failed = []
-
-                        for uid in uids:
-                            if uid not in self.actorInfo:
-                                failed.append( errorMessage( 'actor not found' ) )
-                            else:
-                                instance = self.actorInfo[ uid ][ 'instance' ]
-                                newMsg = instance[ 'socket' ].request( { 'req' : 'kill_actor',
-                                                                         'uid' : uid },
-                                                                       timeout = 10 )
-                                if not isMessageSuccess( newMsg ):
-                                    failed.append( newMsg )
-                                else:
-                                    if not self._removeUidFromDirectory( uid ):
-                                        failed.append( errorMessage( 'error removing actor from directory after stop' ) )
-                                    else:
-                                        self.isActorChanged.set()
-
-                                self._removeInstanceIfIsolated( instance )
-
-                        if 0 != len( failed ):
-                            z.send( errorMessage( 'some actors failed to stop', failed ) )
-                        else:
-                            z.send( successMessage() )
-                elif 'remove_actor' == action:
-                    if 'uid' not in data:
-                        z.send( errorMessage( 'missing information to remove actor' ) )
-                    else:
-                        uid = data[ 'uid' ]
-                        instance = self.actorInfo.get( uid, {} ).get( 'instance', None )
-                        if instance is not None and self._removeUidFromDirectory( uid ):
-                            z.send( successMessage() )
-                            self.isActorChanged.set()
-                            self._removeInstanceIfIsolated( instance )
-                        else:
-                            z.send( errorMessage( 'actor to stop not found' ) )
-                elif 'host_info' == action:
-                    z.send( successMessage( { 'info' : { 'cpu' : psutil.cpu_percent( percpu = True,
-                                                                                     interval = 2 ),
-                                                         'mem' : psutil.virtual_memory().percent } } ) )
-                elif 'get_full_dir' == action:
-                    z.send( successMessage( { 'realms' : self.directory } ) )
-                elif 'get_dir' == action:
-                    realm = data.get( 'realm', 'global' )
-                    if 'cat' in data:
-                        z.send( successMessage( data = { 'endpoints' : self._getDirectoryEntriesFor( realm, data[ 'cat' ] ) } ) )
-                    else:
-                        z.send( errorMessage( 'no category specified' ) )
-                elif 'get_nodes' == action:
-                    nodeList = {}
-                    for k in self.nodes.keys():
-                        nodeList[ k ] = { 'last_seen' : self.nodes[ k ][ 'last_seen' ] }
-                    z.send( successMessage( { 'nodes' : nodeList } ) )
-                elif 'flush' == action:
-                    resp = successMessage()
-                    for uid, actor in self.actorInfo.items():
-                        instance = actor[ 'instance' ]
-                        newMsg = instance[ 'socket' ].request( { 'req' : 'kill_actor',
-                                                                 'uid' : uid },
-                                                               timeout = 10 )
-                        if isMessageSuccess( newMsg ):
-                            if not self._removeUidFromDirectory( uid ):
-                                resp = errorMessage( 'error removing actor from directory after stop' )
-
-                        self._removeInstanceIfIsolated( instance )
-
-                    z.send( resp )
-
-                    if isMessageSuccess( resp ):
-                        self.isActorChanged.set()
-                elif 'get_dir_sync' == action:
-                    z.send( successMessage( { 'directory' : self.directory, 'tombstones' : self.tombstones } ) )
-                elif 'push_dir_sync' == action:
-                    if 'directory' in data and 'tombstones' in data:
-                        self._updateDirectoryWith( self.directory, data[ 'directory' ] )
-                        for uid in data[ 'tombstones' ]:
-                            self._removeUidFromDirectory( uid )
-                        z.send( successMessage() )
-                    else:
-                        z.send( errorMessage( 'missing information to update directory' ) )
-                else:
-                    z.send( errorMessage( 'unknown request', data = { 'req' : action } ) )
+                self._log( "Received new ops request: %s" % data[ 'req' ] )
+                try:
+                    ret = self._handleOpsRequest( data )
+                except gevent.GreenletExit:
+                    raise
+                except:
+                    self._logCritical( traceback.format_exc() )
+                    ret = errorMessage( 'exception', { 'st' : traceback.format_exc() } )
+                z.send( ret )
             else:
                 z.send( errorMessage( 'invalid request' ) )
                 self._logCritical( "Received completely invalid request" )
+
+    def _handleOpsRequest( self, data ):
+        ret = None
+        action = data[ 'req' ]
+        if 'keepalive' == action:
+            if 'from' in data and data[ 'from' ] not in self.nodes:
+                self._log( "Discovered new node: %s" % data[ 'from' ] )
+                self._connectToNode( data[ 'from' ] )
+            ret = successMessage()
+        elif 'start_actor' == action:
+            if 'actor_name' not in data or 'cat' not in data:
+                ret = errorMessage( 'missing information to start actor' )
+            else:
+                category = data[ 'cat' ]
+                spec, instance = self._prepareActor( data[ 'actor_name' ],
+                                                     category,
+                                                     data.get( 'realm', 'global' ),
+                                                     data.get( 'parameters', {} ),
+                                                     data.get( 'isolated', False ) )
+                startReq = { 'req' : 'start_actor' }
+                startReq.update( spec )
+                newMsg = instance[ 'socket' ].request( startReq, timeout = 10 )
+                self._registerStartedActor( spec, category, newMsg )
+                ret = newMsg
+        elif 'start_actors' == action:
+            if 'actor_name' not in data or 'cat' not in data:
+                ret = errorMessage( 'missing information to start actors' )
+            else:
+                category = data[ 'cat' ]
+                perInstance = {}
+                for n in range( data.get( 'count', 1 ) ):
+                    spec, instance = self._prepareActor( data[ 'actor_name' ],
+                                                         category,
+                                                         data.get( 'realm', 'global' ),
+                                                         data.get( 'parameters', {} ),
+                                                         data.get( 'isolated', False ) )
+                    perInstance.setdefault( instance[ 'id' ], ( instance, [] ) )[ 1 ].append( spec )
+
+                # All the instances load their batch concurrently
+                jobs = [ gevent.spawn( self._startActorsInInstance, instance, category, specs )
+                         for instance, specs in perInstance.values() ]
+                gevent.joinall( jobs )
+
+                results = []
+                for job in jobs:
+                    if job.successful():
+                        results += job.value
+                    else:
+                        results.append( errorMessage( 'exception', { 'st' : str( job.exception ) } ) )
+
+                if all( isMessageSuccess( x ) for x in results ):
+                    ret = successMessage( { 'actors' : results } )
+                else:
+                    ret = errorMessage( 'some actors failed to start', { 'actors' : results } )
+        elif 'kill_actor' == action:
+            if 'uid' not in data:
+                ret = errorMessage( 'missing information to stop actor' )
+            else:
+                uids = data[ 'uid' ]
+                if not isinstance( uids, collections.Iterable ) or isinstance( uids, basestring ):
+                    uids = ( uids, )
+
+                failed = self._stopActors( uids )
+
+                if 0 != len( failed ):
+                    ret = errorMessage( 'some actors failed to stop', failed )
+                else:
+                    ret = successMessage()
+        elif 'remove_actor' == action:
+            if 'uid' not in data:
+                ret = errorMessage( 'missing information to remove actor' )
+            else:
+                uid = data[ 'uid' ]
+                instance = self.actorInfo.get( uid, {} ).get( 'instance', None )
+                if instance is not None and self._removeUidFromDirectory( uid ):
+                    self.isActorChanged.set()
+                    self._removeInstanceIfIsolated( instance )
+                    ret = successMessage()
+                else:
+                    ret = errorMessage( 'actor to stop not found' )
+        elif 'host_info' == action:
+            # Metrics come from the background sampler so we never block here
+            if 0 == len( self.hostMetrics ):
+                self.hostMetrics.append( self._sampleMetrics() )
+            resp = { 'info' : self.hostMetrics[ -1 ],
+                     'cpu_affinity' : self.instance_cpu_affinity,
+                     'numa_nodes' : self.numaNodes }
+            nHistory = data.get( 'history', 0 )
+            if 0 != nHistory:
+                resp[ 'history' ] = list( self.hostMetrics )[ -nHistory : ]
+            ret = successMessage( resp )
+        elif 'get_code_manifest' == action:
+            if 'realm' not in data:
+                ret = errorMessage( 'missing information to get code manifest' )
+            else:
+                manifest = self._getCodeManifest( data[ 'realm' ] )
+                if manifest is None:
+                    ret = errorMessage( 'invalid realm' )
+                else:
+                    ret = successMessage( manifest )
+        elif 'get_code_file' == action:
+            if 'realm' not in data or 'path' not in data:
+                ret = errorMessage( 'missing information to get code file' )
+            else:
+                content = self._getCodeFile( data[ 'realm' ], data[ 'path' ] )
+                if content is None:
+                    ret = errorMessage( 'code file not found' )
+                else:
+                    ret = successMessage( { 'content' : base64.b64encode( content ) } )
+        elif 'get_full_dir' == action:
+            ret = self._getFullDirectoryReply( data )
+        elif 'get_dir' == action:
+            ret = self._getDirectoryReply( data )
+        elif 'get_dirs' == action:
+            ret = self._getDirectoriesReply( data )
+        elif 'get_nodes' == action:
+            nodeList = {}
+            for k in self.nodes.keys():
+                nodeList[ k ] = { 'last_seen' : self.nodes[ k ][ 'last_seen' ] }
+            ret = successMessage( { 'nodes' : nodeList } )
+        elif 'flush' == action:
+            # A realm can be specified to only flush the actors of that realm
+            realm = data.get( 'realm', None )
+            uids = [ uid for uid, actor in self.actorInfo.items()
+                     if 'instance' in actor and ( realm is None or actor.get( 'realm', None ) == realm ) ]
+
+            failed = self._stopActors( uids )
+
+            if 0 != len( failed ):
+                ret = errorMessage( 'some actors failed to stop', failed )
+            else:
+                ret = successMessage()
+        elif 'get_dir_sync' == action:
+            # The requester gives back the 'ts' we sent it on the previous sync
+            # so we only need to send the tombstones created since then.
+            ret = successMessage( { 'directory' : self.directory,
+                                    'tombstones' : self._getTombstonesSince( data.get( 'since', None ) ),
+                                    'ts' : int( time.time() ) } )
+        elif 'push_dir_sync' == action:
+            if 'directory' in data and 'tombstones' in data:
+                self._updateDirectoryWith( self.directory, data[ 'directory' ] )
+                for uid in data[ 'tombstones' ]:
+                    self._removeUidFromDirectory( uid )
+                ret = successMessage()
+            else:
+                ret = errorMessage( 'missing information to update directory' )
+        else:
+            ret = errorMessage( 'unknown request', data = { 'req' : action } )
+
+        return ret
     
     def _svc_directory_requests( self ):
         z = self.directoryPort.getChild()
@@ -402,16 +984,15 @@ class HostManager ( object ):
             data = z.recv()
 
             self._log( "Received directory request" )
-            
-            realm = data.get( 'realm', 'global' )
-            if 'cat' in data:
-                z.send( successMessage( data = { 'endpoints' : self._getDirectoryEntriesFor( realm, data[ 'cat' ] ) } ) )
+
+            if 'get_dirs' == data.get( 'req', None ):
+                z.send( self._getDirectoriesReply( data ) )
             else:
-                z.send( errorMessage( 'no category specified' ) )
+                z.send( self._getDirectoryReply( data ) )
     
     def _svc_instance_keepalive( self ):
         while not self.stopEvent.wait( 0 ):
-            for instance in self.processes:
+            for instance in list( self.processes ):
                 self._log( "Issuing keepalive for instance %s" % instance[ 'id' ] )
 
                 if self.initialProcesses and instance[ 'p' ] is not None:
@@ -421,22 +1002,21 @@ class HostManager ( object ):
                     # For first instances, immediately trigger the instance creation
                     data = False
 
-                if not isMessageSuccess( data ):
+                if isMessageSuccess( data ):
+                    instance[ 'ready' ] = True
+                else:
                     isBrandNew = True
                     if instance[ 'p' ] is not None:
                         instance[ 'p' ].kill()
+                        # Collected in the background so it doesn't linger once it exits
+                        gevent.spawn( self._reapProcess, instance[ 'p' ] )
                         # Instance died, it means all Actors within are no longer reachable
                         self._removeInstanceActorsFromDirectory( instance )
                         self.isActorChanged.set()
                         isBrandNew = False
 
-                    if isBrandNew or not instance[ 'isolated' ]:
-                        proc = subprocess.Popen( [ 'python',
-                                                   '%s/ActorHost.py' % self.py_beach_dir,
-                                                    self.configFilePath,
-                                                    instance[ 'id' ] ] )
-
-                        instance[ 'p' ] = proc
+                    if isBrandNew or not instance[ 'isolated' ] or instance[ 'warm' ]:
+                        proc = self._launchInstance( instance )
 
                         if not isBrandNew:
                             self._logCritical( "Instance %s died, restarting it, pid %d" % ( instance[ 'id' ], proc.pid ) )
@@ -446,7 +1026,8 @@ class HostManager ( object ):
                         # This means it's an isolated Actor that died, in this case
                         # we don't restart it, we leave it to higher layers to restarts it
                         # if they want.
-                        self.processes.remove( instance )
+                        if instance in self.processes:
+                            self.processes.remove( instance )
 
             if not self.initialProcesses:
                 self.initialProcesses = True
@@ -454,6 +1035,73 @@ class HostManager ( object ):
             self.isInstanceChanged.wait( self.instance_keepalive_seconds )
             self.isInstanceChanged.clear()
     
+    def _launchInstance( self, instance ):
+        proc = None
+        if self.forkServer is not None:
+            proc = self.forkServer.spawn( instance[ 'id' ] )
+            if proc is None:
+                self._logCritical( "Fork server unavailable, starting instance %s from scratch" % instance[ 'id' ] )
+        if proc is None:
+            proc = subprocess.Popen( [ 'python',
+                                       '%s/ActorHost.py' % self.py_beach_dir,
+                                        self.configFilePath,
+                                        instance[ 'id' ] ] )
+
+        instance[ 'p' ] = proc
+        instance[ 'ready' ] = False
+        if self.instance_cpu_affinity:
+            self._pinInstance( instance )
+        gevent.spawn( self._waitForInstanceReady, instance )
+
+        return proc
+
+    def _getNumaNodes( self ):
+        # Returns the list of cpus of each NUMA node, from the layout in sysfs or a
+        # single node with all the cpus we're allowed to run on.
+        nodes = []
+        for nodeDir in sorted( glob.glob( '/sys/devices/system/node/node[0-9]*' ),
+                               key = lambda x: int( x.rsplit( 'node', 1 )[ 1 ] ) ):
+            try:
+                with open( os.path.join( nodeDir, 'cpulist' ), 'r' ) as f:
+                    cpuList = f.read().strip()
+            except IOError:
+                continue
+            cpus = []
+            for cpuRange in cpuList.split( ',' ):
+                if '' == cpuRange:
+                    continue
+                bounds = cpuRange.split( '-' )
+                cpus += range( int( bounds[ 0 ] ), int( bounds[ -1 ] ) + 1 )
+            if 0 != len( cpus ):
+                nodes.append( cpus )
+
+        allowed = psutil.Process().cpu_affinity()
+        nodes = [ [ cpu for cpu in node if cpu in allowed ] for node in nodes ]
+        nodes = [ node for node in nodes if 0 != len( node ) ]
+        if 0 == len( nodes ):
+            nodes = [ allowed ]
+        return nodes
+
+    def _pinInstance( self, instance ):
+        # An instance keeps its cpus across restarts, new ones take the least used slot.
+        if instance[ 'cpus' ] is None:
+            if 'numa' == self.instance_cpu_affinity:
+                slots = self.numaNodes
+            else:
+                # Cores are ordered node by node so neighbouring instances share a node
+                slots = [ [ cpu ] for node in self.numaNodes for cpu in node ]
+            used = [ x[ 'cpus' ] for x in self.processes if x is not instance ]
+            instance[ 'cpus' ] = min( slots, key = lambda x: used.count( x ) )
+        try:
+            psutil.Process( instance[ 'p' ].pid ).cpu_affinity( instance[ 'cpus' ] )
+        except ( psutil.Error, ValueError, OSError ), e:
+            self._logCritical( "Could not pin instance %s to cpus %s: %s" % ( instance[ 'id' ], instance[ 'cpus' ], str( e ) ) )
+
+    def _waitForInstanceReady( self, instance ):
+        # The request is queued until the instance is up and listening
+        if isMessageSuccess( instance[ 'socket' ].request( { 'req' : 'keepalive' }, timeout = 30 ) ):
+            instance[ 'ready' ] = True
+
     def _svc_host_keepalive( self ):
         while not self.stopEvent.wait( 0 ):
             for nodeName, node in self.nodes.items():
@@ -486,9 +1134,11 @@ class HostManager ( object ):
                 node = self.nodes[ nodeName ]
                 if nodeName != self.ifaceIp4:
                     self._log( "Issuing directory sync with node %s" % nodeName )
-                    data = node[ 'socket' ].request( { 'req' : 'get_dir_sync' } )
+                    data = node[ 'socket' ].request( { 'req' : 'get_dir_sync',
+                                                       'since' : node[ 'last_sync' ] } )
 
                     if isMessageSuccess( data ):
+                        node[ 'last_sync' ] = data.get( 'ts', None )
                         self._updateDirectoryWith( self.directory, data[ 'directory' ] )
                         for uid in data[ 'tombstones' ]:
                             self._removeUidFromDirectory( uid )
@@ -501,12 +1151,72 @@ class HostManager ( object ):
             # We "accumulate" updates for 5 seconds once they occur to limit updates pushed
             gevent.sleep( 5 )
             self.isActorChanged.clear()
+            # Peers only need the tombstones created since the last push, older
+            # ones were either pushed already or will come through the periodic sync.
+            newTombstones = self.newTombstones
+            self.newTombstones = []
             for nodeName, node in self.nodes.items():
                 if nodeName != self.ifaceIp4:
                     self._log( "Pushing new directory update to %s" % nodeName )
                     node[ 'socket' ].request( { 'req' : 'push_dir_sync',
                                                 'directory' : self.directory,
-                                                'tombstones' : self.tombstones } )
+                                                'tombstones' : newTombstones } )
+
+    def _sampleMetrics( self ):
+        now = time.time()
+
+        netCounters = psutil.net_io_counters()
+        net = { 'sent_bps' : 0, 'recv_bps' : 0 }
+        if self.lastNetCounters is not None:
+            lastTime, lastCounters = self.lastNetCounters
+            elapsed = max( now - lastTime, 0.001 )
+            net[ 'sent_bps' ] = int( ( netCounters.bytes_sent - lastCounters.bytes_sent ) / elapsed )
+            net[ 'recv_bps' ] = int( ( netCounters.bytes_recv - lastCounters.bytes_recv ) / elapsed )
+        self.lastNetCounters = ( now, netCounters )
+
+        nActors = self._getActorsPerInstance()
+
+        instances = {}
+        procs = {}
+        for instance in self.processes:
+            if instance[ 'p' ] is None:
+                continue
+            pid = instance[ 'p' ].pid
+            # We keep the same psutil.Process between samples since cpu_percent()
+            # reports the usage since the previous call on the same object.
+            proc = self.instanceProcs.get( pid, None )
+            try:
+                if proc is None:
+                    proc = psutil.Process( pid )
+                instances[ instance[ 'id' ] ] = { 'pid' : pid,
+                                                  'cpu' : proc.cpu_percent( interval = None ),
+                                                  'mem' : proc.memory_info().rss,
+                                                  'n_actors' : nActors.get( instance[ 'id' ], 0 ),
+                                                  'cpus' : instance[ 'cpus' ] }
+                procs[ pid ] = proc
+            except psutil.Error:
+                pass
+        self.instanceProcs = procs
+
+        return { 'ts' : int( now ),
+                 'cpu' : psutil.cpu_percent( percpu = True, interval = None ),
+                 'mem' : psutil.virtual_memory().percent,
+                 'load' : os.getloadavg(),
+                 'net' : net,
+                 'instances' : instances }
+
+    def _svc_sampleMetrics( self ):
+        while not self.stopEvent.wait( 0 ):
+            self.hostMetrics.append( self._sampleMetrics() )
+            gevent.sleep( self.metrics_sample_seconds )
+
+    def _svc_publishDirMirror( self ):
+        while not self.stopEvent.wait( 0 ):
+            self.dirMirror.publish( { 'realms' : self.directory,
+                                      'epoch' : self.dirEpoch,
+                                      'gens' : self.dirGenerations } )
+            self.isDirChanged.wait()
+            self.isDirChanged.clear()
 
     def _initLogging( self ):
         logging.basicConfig( format = "%(asctime)-15s %(message)s" )
@@ -14,10 +14,26 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import os
+import stat
+import errno
 import uuid
 import datetime
+import json
+import mmap
+import struct
+import time
+import sys
+import imp
+import marshal
+import hashlib
+import traceback
 import gevent
 import gevent.coros
+import gevent.queue
+import gevent.pool
+import gevent.event
+import collections
 import zmq.green as zmq
 import netifaces
 
@@ -163,6 +179,9 @@ class _ZSocket( object ):
 
     def close( self ):
         self.s.close()
+        # The context is ours alone, its I/O thread and the sockets left over by
+        # rebuilds after timeouts go with it
+        self.ctx.destroy( linger = 0 )
 
 class _ZMREQ ( object ):
     def __init__( self, url, isBind ):
@@ -202,13 +221,17 @@ class _ZMREQ ( object ):
         return result
 
 class _ZMREP ( object ):
-    def __init__( self, url, isBind ):
+    def __init__( self, url, isBind, lanes = None ):
         self._available = []
         self._url = url
         self._isBind = isBind
         self._ctx = zmq.Context()
         self._threads = gevent.pool.Group()
         self._intUrl = 'inproc://%s' % str( uuid.uuid4() )
+        # Lanes let specific request types be served by their own children so
+        # they never queue behind slow requests of other types.
+        self._lanes = {}
+        self._laneUrls = { None : self._intUrl }
 
         zFront = self._ctx.socket( zmq.ROUTER )
         zBack = self._ctx.socket( zmq.DEALER )
@@ -219,15 +242,31 @@ class _ZMREP ( object ):
         else:
             zFront.connect( self._url )
         zBack.bind( self._intUrl )
-        self._proxySocks = ( zFront, zBack )
-        self._threads.add( gevent.spawn( self._proxy, zFront, zBack ) )
+        self._proxySocks = [ zFront, zBack ]
+
+        if lanes is None:
+            self._threads.add( gevent.spawn( self._proxy, zFront, zBack ) )
+        else:
+            zBacks = { None : zBack }
+            for laneName, reqTypes in lanes.iteritems():
+                laneUrl = 'inproc://%s' % str( uuid.uuid4() )
+                zLane = self._ctx.socket( zmq.DEALER )
+                zLane.set( zmq.LINGER, 0 )
+                zLane.bind( laneUrl )
+                self._laneUrls[ laneName ] = laneUrl
+                self._proxySocks.append( zLane )
+                zBacks[ laneName ] = zLane
+                for reqType in reqTypes:
+                    self._lanes[ reqType ] = laneName
+                self._threads.add( gevent.spawn( self._proxy, zLane, zFront ) )
+            self._threads.add( gevent.spawn( self._proxyLanes, zFront, zBacks ) )
         self._threads.add( gevent.spawn( self._proxy, zBack, zFront ) )
 
     def close( self ):
         self._threads.kill()
-        self._proxySocks[ 0 ].close()
-        self._proxySocks[ 1 ].close()
-        self._proxySocks = ( None, None )
+        for z in self._proxySocks:
+            z.close()
+        self._proxySocks = []
 
     class _childSock( object ):
         def __init__( self, z ):
@@ -267,13 +306,13 @@ class _ZMREP ( object ):
 
             return data
 
-    def getChild( self ):
-        return self._childSock( self._newSocket() )
+    def getChild( self, lane = None ):
+        return self._childSock( self._newSocket( lane ) )
 
-    def _newSocket( self ):
+    def _newSocket( self, lane = None ):
         z = self._ctx.socket( zmq.REP )
         z.set( zmq.LINGER, 0 )
-        z.connect( self._intUrl )
+        z.connect( self._laneUrls[ lane ] )
         return z
 
     def _proxy( self, zFrom, zTo ):
@@ -281,6 +320,484 @@ class _ZMREP ( object ):
             msg = zFrom.recv_multipart()
             zTo.send_multipart( msg )
 
+    def _proxyLanes( self, zFrom, zTos ):
+        while True:
+            msg = zFrom.recv_multipart()
+            lane = None
+            try:
+                lane = self._lanes.get( json.loads( msg[ -1 ] ).get( 'req', None ), None )
+            except:
+                # Let the default lane reply to whatever this is
+                lane = None
+            zTos[ lane ].send_multipart( msg )
+
+
+class _ZMROUTER ( object ):
+    # Requests are read straight from the ROUTER socket into bounded queues that
+    # a pool of greenlets drains, so there is no internal hop and the concurrency
+    # is just the number of greenlets calling getRequest(). When a queue is full
+    # we either reply right away with what onFull( data ) returns, or stop reading
+    # and let ZMQ queue up the requests.
+    # Request types in immediate are answered by their callback as soon as they are
+    # read, without going through the queues.
+    # Each request goes to the queue laneOf( data ) returns, either a lane or a
+    # ( lane, name ) queue of its own within a lane. Lanes are served in proportion
+    # of their weight, by virtual time like a fair queue, and within a lane the
+    # oldest request goes first. A paused queue keeps its requests until resumed.
+    # Exclusive lanes are only served by the greenlets asking for them specifically.
+    def __init__( self, url, isBind, queueSize = 1000, onFull = None, immediate = None, laneOf = None ):
+        self._url = url
+        self._isBind = isBind
+        self._ctx = zmq.Context()
+        self._queueSize = queueSize
+        self._onFull = onFull
+        self._immediate = immediate or {}
+        self._laneOf = laneOf
+        self._queues = { None : collections.deque() }
+        self._paused = set()
+        self._weights = {}
+        self._exclusive = set()
+        self._depths = { None : 0 }
+        self._vtimes = { None : 0.0 }
+        self._vnow = 0.0
+        self._waiters = { None : collections.deque() }
+        self._hasRoom = gevent.event.Event()
+
+        self._z = self._ctx.socket( zmq.ROUTER )
+        self._z.set( zmq.LINGER, 0 )
+        if self._isBind:
+            self._z.bind( self._url )
+        else:
+            self._z.connect( self._url )
+
+        self._thread = gevent.spawn( self._receive )
+
+    @classmethod
+    def _getLaneOf( cls, key ):
+        return key[ 0 ] if type( key ) is tuple else key
+
+    def setLaneWeight( self, lane, weight ):
+        self._weights[ lane ] = float( weight )
+
+    def setLaneExclusive( self, lane, isExclusive ):
+        if isExclusive:
+            self._exclusive.add( lane )
+        else:
+            self._exclusive.discard( lane )
+
+    def pause( self, key ):
+        self._paused.add( key )
+
+    def resume( self, key ):
+        if key in self._paused:
+            self._paused.remove( key )
+            if 0 != len( self._queues.get( key, () ) ):
+                self._wakeWaiter( self._getLaneOf( key ) )
+
+    def _receive( self ):
+        while True:
+            msg = self._z.recv_multipart()
+            # The envelope is everything up to the payload, it routes the reply back
+            try:
+                data = json.loads( msg[ -1 ] )
+            except:
+                data = None
+            if type( data ) is dict and isinstance( data.get( 'req', None ), basestring ) and data[ 'req' ] in self._immediate:
+                try:
+                    ret = self._immediate[ data[ 'req' ] ]( data )
+                except:
+                    # The reader must survive anything a callback does
+                    ret = errorMessage( 'exception', { 'st' : traceback.format_exc() } )
+                self.reply( msg[ : -1 ], ret )
+                continue
+
+            key = self._laneOf( data ) if self._laneOf is not None else None
+            lane = self._getLaneOf( key )
+            queue = self._queues.get( key, None )
+            if queue is None:
+                queue = self._queues.setdefault( key, collections.deque() )
+                self._depths.setdefault( lane, 0 )
+                self._vtimes.setdefault( lane, self._vnow )
+            if len( queue ) >= self._queueSize:
+                if self._onFull is not None:
+                    self.reply( msg[ : -1 ], self._onFull( data ) )
+                    continue
+                while len( queue ) >= self._queueSize:
+                    self._hasRoom.clear()
+                    self._hasRoom.wait()
+
+            if 0 == self._depths[ lane ]:
+                # An idle lane doesn't get to bank credit for the time it was idle
+                self._vtimes[ lane ] = max( self._vtimes[ lane ], self._vnow )
+            queue.append( ( msg[ : -1 ], data, time.time() ) )
+            self._depths[ lane ] += 1
+            if key not in self._paused:
+                self._wakeWaiter( lane )
+
+    def _wakeWaiter( self, lane ):
+        # A handler dedicated to the lane gets it first, then any handler
+        for waiters in ( self._waiters.get( lane, None ),
+                         self._waiters[ None ] if lane not in self._exclusive else None ):
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.ready():
+                    waiter.set()
+                    return
+
+    def _pop( self, lane ):
+        keys = [ x for x, queue in self._queues.iteritems()
+                 if 0 != len( queue ) and
+                    x not in self._paused and
+                    ( lane == self._getLaneOf( x ) or
+                      ( lane is None and self._getLaneOf( x ) not in self._exclusive ) ) ]
+        if 0 == len( keys ):
+            return None
+        lane = min( set( self._getLaneOf( x ) for x in keys ), key = lambda x: self._vtimes[ x ] )
+        queue = min( ( self._queues[ x ] for x in keys if lane == self._getLaneOf( x ) ),
+                     key = lambda x: x[ 0 ][ 2 ] )
+        self._vnow = self._vtimes[ lane ]
+        self._vtimes[ lane ] += 1.0 / self._weights.get( lane, 1.0 )
+        self._depths[ lane ] -= 1
+        self._hasRoom.set()
+        return queue.popleft()
+
+    def getRequest( self, timeout = None, lane = None ):
+        '''Returns the next ( envelope, data, receivedAt ) to serve, or None on timeout.
+
+        :param lane: only serve the requests of this lane, by default all lanes are served
+        '''
+        endTime = None if timeout is None else time.time() + timeout
+        while True:
+            req = self._pop( lane )
+            if req is not None:
+                return req
+            remaining = None
+            if endTime is not None:
+                remaining = endTime - time.time()
+                if remaining <= 0:
+                    return None
+            waiter = gevent.event.Event()
+            waiters = self._waiters.setdefault( lane, collections.deque() )
+            waiters.append( waiter )
+            waiter.wait( remaining )
+            if not waiter.ready():
+                # Timed out, a waiter left behind would swallow the next wake up
+                waiters.remove( waiter )
+
+    def reply( self, envelope, data ):
+        # A ROUTER never blocks on send, so replies from many greenlets don't interleave
+        self._z.send_multipart( envelope + [ json.dumps( _sanitizeJson( data ) ) ] )
+
+    def getQueueDepth( self, key = False ):
+        '''Returns the number of requests waiting in a lane or ( lane, name ) queue, or in all of them.'''
+        if key is False:
+            return sum( self._depths.itervalues() )
+        if type( key ) is tuple:
+            return len( self._queues.get( key, () ) )
+        return self._depths.get( key, 0 )
+
+    def close( self ):
+        self._thread.kill()
+        self._z.close()
+
+class _DirectoryMirror ( object ):
+    # The mirror file is a fixed header followed by the directory as compact json:
+    #   magic (4 bytes) | sequence (uint64) | payload length (uint64) | payload
+    # The writer makes the sequence odd while it updates the payload and even once
+    # it is done, so readers never lock, they just retry if the sequence was odd or
+    # changed while they were copying the payload.
+    _HEADER = struct.Struct( '<4sQQ' )
+    _MAGIC = 'BDM1'
+
+    def __init__( self, path, isWriter = False ):
+        self._path = path
+        self._isWriter = isWriter
+        self._fd = None
+        self._map = None
+        self._seq = 0
+        self._cache = None
+        self._cacheSeq = None
+        self._nextOpenAttempt = 0
+
+        if self._isWriter:
+            self._fd = self._openOwned( os.O_RDWR | os.O_CREAT )
+            if os.fstat( self._fd ).st_size < self._HEADER.size:
+                os.ftruncate( self._fd, self._HEADER.size )
+            self._map = mmap.mmap( self._fd, os.fstat( self._fd ).st_size )
+            magic, seq, length = self._HEADER.unpack_from( self._map, 0 )
+            # If a previous HostManager left a mirror behind we keep counting from it
+            # so readers never mistake new content for what they have cached.
+            if magic == self._MAGIC:
+                self._seq = seq + ( seq & 1 )
+
+    def _openOwned( self, flags ):
+        # The file lives in a shared directory like /tmp, so we only trust one
+        # we own and that nobody else can write to, never following a link.
+        fd = os.open( self._path, flags | os.O_NOFOLLOW, 0644 )
+        info = os.fstat( fd )
+        if( not stat.S_ISREG( info.st_mode ) or
+            info.st_uid != os.getuid() or
+            0 != ( info.st_mode & 0022 ) ):
+            os.close( fd )
+            raise OSError( errno.EPERM, 'directory mirror must be a file owned by us and only writable by us', self._path )
+        return fd
+
+    def _open( self ):
+        if time.time() < self._nextOpenAttempt:
+            return False
+        try:
+            self._fd = self._openOwned( os.O_RDONLY )
+            self._map = mmap.mmap( self._fd, os.fstat( self._fd ).st_size, access = mmap.ACCESS_READ )
+        except ( OSError, mmap.error, ValueError ):
+            if self._fd is not None:
+                os.close( self._fd )
+                self._fd = None
+            self._map = None
+            self._nextOpenAttempt = time.time() + 1
+            return False
+        return True
+
+    def _remap( self ):
+        self._map.close()
+        self._map = mmap.mmap( self._fd, os.fstat( self._fd ).st_size, access = mmap.ACCESS_READ )
+
+    def publish( self, data ):
+        payload = json.dumps( _sanitizeJson( data ), separators = ( ',', ':' ) )
+        needed = self._HEADER.size + len( payload )
+        if needed > len( self._map ):
+            # The file only ever grows, so mappings readers already have stay valid
+            # and they remap when they see a payload larger than their mapping.
+            os.ftruncate( self._fd, max( needed, len( self._map ) * 2 ) )
+            self._map.close()
+            self._map = mmap.mmap( self._fd, os.fstat( self._fd ).st_size )
+        self._seq += 1
+        self._HEADER.pack_into( self._map, 0, self._MAGIC, self._seq, 0 )
+        self._map[ self._HEADER.size : needed ] = payload
+        self._seq += 1
+        self._HEADER.pack_into( self._map, 0, self._MAGIC, self._seq, len( payload ) )
+
+    def read( self ):
+        '''Returns the last published data or None if it is not available.'''
+        if self._map is None and not self._open():
+            return None
+
+        for attempt in xrange( 3 ):
+            magic, seq, length = self._HEADER.unpack_from( self._map, 0 )
+            if magic != self._MAGIC:
+                return None
+            if seq == self._cacheSeq:
+                return self._cache
+            if 0 != ( seq & 1 ):
+                continue
+            end = self._HEADER.size + length
+            if end > len( self._map ):
+                self._remap()
+                continue
+            payload = self._map[ self._HEADER.size : end ]
+            if self._HEADER.unpack_from( self._map, 0 )[ 1 ] != seq:
+                continue
+            self._cache = json.loads( payload )
+            self._cacheSeq = seq
+            return self._cache
+
+        return None
+
+    def close( self ):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close( self._fd )
+            self._fd = None
+
+
+class _ModuleCache ( object ):
+    # Modules are loaded once per process and path, a file is only read and hashed
+    # again if its mtime or size changed. The module name includes the content hash
+    # so a changed file becomes a new module while actors using the old one keep it.
+    # Compiled code is kept on local disk per content hash so other instances on the
+    # node, and restarted ones, skip compiling.
+
+    def __init__( self, cacheDirectory = None ):
+        self._cacheDirectory = cacheDirectory
+        self._modules = {}
+        self._stats = { 'hits' : 0,
+                        'disk_hits' : 0,
+                        'compiles' : 0,
+                        'loads' : 0,
+                        'load_time' : 0.0 }
+
+        # The cached code gets executed, a directory others can write to is not used
+        if self._cacheDirectory is not None and not _makePrivateDirectory( self._cacheDirectory ):
+            self._cacheDirectory = None
+
+    def load( self, path, namePrefix ):
+        path = os.path.abspath( path )
+        info = os.stat( path )
+        entry = self._modules.get( path, None )
+        if entry is not None and entry[ 0 ] == info.st_mtime and entry[ 1 ] == info.st_size:
+            self._stats[ 'hits' ] += 1
+            return entry[ 2 ]
+
+        start = time.time()
+        with open( path, 'r' ) as hFile:
+            source = hFile.read()
+        fileHash = hashlib.sha1( source ).hexdigest()
+        moduleName = '%s_%s' % ( namePrefix, fileHash )
+
+        mod = sys.modules.get( moduleName, None )
+        if mod is None:
+            code = self._getCode( path, source, fileHash )
+            mod = imp.new_module( moduleName )
+            mod.__file__ = path
+            sys.modules[ moduleName ] = mod
+            try:
+                exec code in mod.__dict__
+            except:
+                del( sys.modules[ moduleName ] )
+                raise
+            self._stats[ 'loads' ] += 1
+        else:
+            # Same content under a new mtime, the module is still good
+            self._stats[ 'hits' ] += 1
+
+        self._modules[ path ] = ( info.st_mtime, info.st_size, mod )
+        self._stats[ 'load_time' ] += time.time() - start
+        return mod
+
+    def isDiskCached( self ):
+        return self._cacheDirectory is not None
+
+    def _getCode( self, path, source, fileHash ):
+        cacheFile = None
+        if self._cacheDirectory is not None:
+            # The path is part of the key since it is compiled into the code for tracebacks
+            cacheFile = os.path.join( self._cacheDirectory,
+                                      '%s.pyc' % hashlib.sha1( '%s:%s' % ( path, fileHash ) ).hexdigest() )
+            try:
+                with open( cacheFile, 'rb' ) as hFile:
+                    if hFile.read( 4 ) == imp.get_magic():
+                        code = marshal.load( hFile )
+                        self._stats[ 'disk_hits' ] += 1
+                        return code
+            except ( IOError, EOFError, ValueError, TypeError ):
+                pass
+
+        code = compile( source, path, 'exec' )
+        self._stats[ 'compiles' ] += 1
+
+        if cacheFile is not None:
+            # Written to a temporary file first so other instances never read a partial file
+            tmpFile = '%s.%d.tmp' % ( cacheFile, os.getpid() )
+            try:
+                with open( tmpFile, 'wb' ) as hFile:
+                    hFile.write( imp.get_magic() )
+                    marshal.dump( code, hFile )
+                os.rename( tmpFile, cacheFile )
+            except ( IOError, OSError ):
+                pass
+
+        return code
+
+    def getMetrics( self ):
+        metrics = dict( self._stats )
+        metrics[ 'modules' ] = len( self._modules )
+        return metrics
+
+class _ResultCache ( object ):
+    # Results are kept least recently used first, each with the time it expires.
+    # The size of a result is the size of its json, which is close to what it costs
+    # to keep and what we'd send anyway. The total is capped at maxBytes by evicting
+    # from the least recently used.
+
+    def __init__( self, maxBytes ):
+        self._maxBytes = maxBytes
+        self._nBytes = 0
+        self._entries = collections.OrderedDict()
+        self._stats = { 'hits' : 0,
+                        'misses' : 0,
+                        'expired' : 0,
+                        'evicted' : 0,
+                        'invalidated' : 0 }
+
+    @classmethod
+    def getKey( cls, name, data, ignored = () ):
+        '''Returns the key of data under name, the same for equal data whatever its key order.'''
+        if type( data ) is dict:
+            data = dict( ( k, v ) for k, v in data.iteritems() if k not in ignored )
+        canonical = json.dumps( data, sort_keys = True, separators = ( ',', ':' ) )
+        return ( name, hashlib.sha1( canonical ).hexdigest() )
+
+    def get( self, key ):
+        '''Returns ( isHit, value ).'''
+        entry = self._entries.pop( key, None )
+        if entry is not None and entry[ 0 ] < time.time():
+            self._nBytes -= entry[ 1 ]
+            self._stats[ 'expired' ] += 1
+            entry = None
+        if entry is None:
+            self._stats[ 'misses' ] += 1
+            return ( False, None )
+        # Put back as the most recently used
+        self._entries[ key ] = entry
+        self._stats[ 'hits' ] += 1
+        return ( True, entry[ 2 ] )
+
+    def set( self, key, value, ttl ):
+        try:
+            size = len( json.dumps( _sanitizeJson( value ) ) )
+        except ( TypeError, ValueError ):
+            return
+        self._remove( key )
+        if size > self._maxBytes:
+            return
+        while self._nBytes + size > self._maxBytes:
+            self._remove( next( iter( self._entries ) ) )
+            self._stats[ 'evicted' ] += 1
+        self._entries[ key ] = ( time.time() + ttl, size, value )
+        self._nBytes += size
+
+    def _remove( self, key ):
+        entry = self._entries.pop( key, None )
+        if entry is not None:
+            self._nBytes -= entry[ 1 ]
+        return entry is not None
+
+    def invalidate( self, name = None, key = None ):
+        '''Drops the entry at key, all the entries under name, or everything.'''
+        if key is not None:
+            keys = [ key ]
+        elif name is not None:
+            keys = [ x for x in self._entries.iterkeys() if x[ 0 ] == name ]
+        else:
+            keys = self._entries.keys()
+        for x in keys:
+            if self._remove( x ):
+                self._stats[ 'invalidated' ] += 1
+
+    def getMetrics( self ):
+        metrics = dict( self._stats )
+        lookups = metrics[ 'hits' ] + metrics[ 'misses' ]
+        metrics[ 'hit_rate' ] = float( metrics[ 'hits' ] ) / lookups if 0 != lookups else None
+        metrics[ 'entries' ] = len( self._entries )
+        metrics[ 'bytes' ] = self._nBytes
+        metrics[ 'max_bytes' ] = self._maxBytes
+        return metrics
+
+def _makePrivateDirectory( path ):
+    '''Creates the directory only we can write to if needed, returns False if it
+       exists but others could write to it, as what it holds gets executed.'''
+    try:
+        os.makedirs( path, 0700 )
+    except OSError:
+        pass
+    try:
+        info = os.lstat( path )
+    except OSError:
+        return False
+    return ( stat.S_ISDIR( info.st_mode ) and
+             info.st_uid == os.getuid() and
+             0 == ( info.st_mode & 0077 ) )
 
 def _getIpv4ForIface( iface ):
     ip = None
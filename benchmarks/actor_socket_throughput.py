@@ -0,0 +1,74 @@
+# Measures the request throughput of the socket an actor serves from, comparing
+# the REP children behind the ROUTER / DEALER proxy actors used to serve from
+# with the ROUTER feeding a queue drained by a pool of handlers. The clients
+# run on the same host, so the server cpu time per request is reported too.
+#   python actor_socket_throughput.py [seconds] [nClients] [nHandlers]
+
+import sys
+import os
+import time
+import multiprocessing
+import psutil
+import gevent
+import zmq.green as zmq
+
+# Adding the beach lib directory relatively for this benchmark
+curFileDir = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.append( os.path.join( curFileDir, '..' ) )
+
+from beach.utils import *
+from beach.utils import _ZMREP
+from beach.utils import _ZMROUTER
+from beach.utils import _ZSocket
+
+URL = 'tcp://127.0.0.1:5999'
+
+def serveRep( nHandlers ):
+    server = _ZMREP( URL, isBind = True )
+    def handler():
+        z = server.getChild()
+        while True:
+            msg = z.recv()
+            z.send( successMessage( { 'echo' : msg.get( 'data', None ) } ) )
+    gevent.joinall( [ gevent.spawn( handler ) for n in range( nHandlers ) ] )
+
+def serveRouter( nHandlers ):
+    server = _ZMROUTER( URL, isBind = True )
+    def handler():
+        while True:
+            envelope, msg, receivedAt = server.getRequest()
+            server.reply( envelope, successMessage( { 'echo' : msg.get( 'data', None ) } ) )
+    gevent.joinall( [ gevent.spawn( handler ) for n in range( nHandlers ) ] )
+
+def runClients( seconds, nClients ):
+    counts = [ 0 ] * nClients
+    deadline = time.time() + seconds
+    def client( n ):
+        z = _ZSocket( zmq.REQ, URL )
+        while time.time() < deadline:
+            if isMessageSuccess( z.request( { 'req' : 'echo', 'data' : n }, timeout = 5 ) ):
+                counts[ n ] += 1
+    gevent.joinall( [ gevent.spawn( client, n ) for n in range( nClients ) ] )
+    return sum( counts )
+
+def measure( serve, seconds, nClients, nHandlers ):
+    server = multiprocessing.Process( target = serve, args = ( nHandlers, ) )
+    server.start()
+    time.sleep( 1 )
+    # Warm up the connections before measuring
+    runClients( 1, nClients )
+    proc = psutil.Process( server.pid )
+    cpuBefore = sum( proc.cpu_times()[ : 2 ] )
+    nRequests = runClients( seconds, nClients )
+    cpuUsed = sum( proc.cpu_times()[ : 2 ] ) - cpuBefore
+    server.terminate()
+    server.join()
+    return ( nRequests / float( seconds ), cpuUsed * 1000000 / max( nRequests, 1 ) )
+
+if __name__ == '__main__':
+    seconds = int( sys.argv[ 1 ] ) if 1 < len( sys.argv ) else 10
+    nClients = int( sys.argv[ 2 ] ) if 2 < len( sys.argv ) else 32
+    nHandlers = int( sys.argv[ 3 ] ) if 3 < len( sys.argv ) else 8
+
+    for name, serve in ( ( 'rep children', serveRep ), ( 'router queue', serveRouter ) ):
+        print( "%s: %.1f req/s, %.1f server cpu us/req" % ( ( name, ) + measure( serve, seconds, nClients, nHandlers ) ) )
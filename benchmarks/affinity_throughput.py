@@ -0,0 +1,78 @@
+# Measures request throughput to cpu bound actors with the instances left
+# unpinned, pinned per core and pinned per NUMA node. It starts its own
+# single node HostManager for every configuration, so no other HostManager
+# should be running.
+#   python affinity_throughput.py [seconds] [nClients]
+
+import sys
+import os
+
+# Adding the beach lib directory relatively for this benchmark
+curFileDir = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.append( os.path.join( curFileDir, '..' ) )
+
+# The api monkey patches gevent, so it goes before anything using threads
+from beach.beach_api import Beach
+from beach.utils import *
+
+import time
+import signal
+import subprocess
+import tempfile
+import multiprocessing
+import yaml
+import gevent
+
+def runWithAffinity( affinity, seconds, nClients ):
+    nInstances = multiprocessing.cpu_count()
+    with open( os.path.join( curFileDir, 'benchmarks.yaml' ), 'r' ) as f:
+        config = yaml.load( f )
+    config[ 'code_directory' ] = curFileDir
+    config[ 'n_processes' ] = nInstances
+    config[ 'instance_strategy' ] = 'round_robin'
+    config[ 'instance_cpu_affinity' ] = affinity
+
+    hConfig, configPath = tempfile.mkstemp( suffix = '.yaml' )
+    with os.fdopen( hConfig, 'w' ) as f:
+        yaml.dump( config, f )
+
+    hostManager = subprocess.Popen( [ sys.executable, '-m', 'beach.hostmanager', configPath ] )
+    # Give the instances time to boot
+    time.sleep( 10 )
+
+    beach = Beach( configPath, realm = 'global' )
+    beach.addActors( 'Worker', 'workers', nInstances )
+    # Let the directory reach the handle
+    time.sleep( 5 )
+
+    handle = beach.getActorHandle( 'workers' )
+    counts = [ 0 ] * nClients
+    deadline = time.time() + seconds
+
+    def client( n ):
+        while time.time() < deadline:
+            resp = handle.request( 'work', { 'payload' : str( n ), 'rounds' : 1000 }, timeout = 10 )
+            # The reply is the plain dict returned by the handler, it has no status
+            if resp is not False and 'digest' in resp:
+                counts[ n ] += 1
+
+    gevent.joinall( [ gevent.spawn( client, n ) for n in range( nClients ) ] )
+
+    handle.close()
+    beach.flush()
+    beach.close()
+    hostManager.send_signal( signal.SIGQUIT )
+    hostManager.wait()
+    os.remove( configPath )
+
+    return { 'affinity' : affinity or 'none',
+             'requests' : sum( counts ),
+             'rate' : sum( counts ) / float( seconds ) }
+
+if __name__ == '__main__':
+    seconds = int( sys.argv[ 1 ] ) if 1 < len( sys.argv ) else 30
+    nClients = int( sys.argv[ 2 ] ) if 2 < len( sys.argv ) else 32
+
+    for affinity in ( None, 'core', 'numa' ):
+        res = runWithAffinity( affinity, seconds, nClients )
+        print( "affinity %(affinity)s: %(requests)d requests, %(rate).1f req/s" % res )
@@ -0,0 +1,18 @@
+from beach.actor import Actor
+import hashlib
+
+
+class Worker ( Actor ):
+
+    def init( self, parameters ):
+        self.handle( 'work', self.work )
+
+    def deinit( self ):
+        pass
+
+    def work( self, msg ):
+        # A bit of cpu bound work on the payload, like most real handlers
+        digest = msg.get( 'payload', '' )
+        for n in xrange( msg.get( 'rounds', 1000 ) ):
+            digest = hashlib.sha1( digest ).hexdigest()
+        return { 'digest' : digest }
@@ -0,0 +1,67 @@
+# Measures how long it takes to spawn isolated actors with and without
+# a pool of warm instances. It starts its own single node HostManager
+# for every configuration, so no other HostManager should be running.
+#   python spawn_latency.py [nActors] [poolSize]
+
+import sys
+import os
+
+# Adding the beach lib directory relatively for this benchmark
+curFileDir = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.append( os.path.join( curFileDir, '..' ) )
+
+# The api monkey patches gevent, so it goes before anything using threads
+from beach.beach_api import Beach
+from beach.utils import *
+
+import time
+import signal
+import subprocess
+import tempfile
+import yaml
+
+def runWithPoolSize( poolSize, nActors ):
+    with open( os.path.join( curFileDir, 'benchmarks.yaml' ), 'r' ) as f:
+        config = yaml.load( f )
+    config[ 'code_directory' ] = curFileDir
+    config[ 'isolated_pool_size' ] = poolSize
+
+    hConfig, configPath = tempfile.mkstemp( suffix = '.yaml' )
+    with os.fdopen( hConfig, 'w' ) as f:
+        yaml.dump( config, f )
+
+    hostManager = subprocess.Popen( [ sys.executable, '-m', 'beach.hostmanager', configPath ] )
+    # Give the instances and the warm pool time to boot
+    time.sleep( 10 )
+
+    beach = Beach( configPath, realm = 'global' )
+    latencies = []
+    for n in range( nActors ):
+        start = time.time()
+        resp = beach.addActor( 'Pong', 'pongers', isIsolated = True )
+        latencies.append( time.time() - start )
+        if not isMessageSuccess( resp ):
+            print( "Failed to spawn actor: %s" % str( resp ) )
+        # Let the pool refill in between spawns, like a normal workload would
+        time.sleep( 2 )
+
+    beach.flush()
+    beach.close()
+    hostManager.send_signal( signal.SIGQUIT )
+    hostManager.wait()
+    os.remove( configPath )
+
+    latencies.sort()
+    return { 'pool' : poolSize,
+             'mean' : sum( latencies ) / len( latencies ),
+             'p50' : latencies[ len( latencies ) / 2 ],
+             'p95' : latencies[ min( int( len( latencies ) * 0.95 ), len( latencies ) - 1 ) ],
+             'max' : latencies[ -1 ] }
+
+if __name__ == '__main__':
+    nActors = int( sys.argv[ 1 ] ) if 1 < len( sys.argv ) else 20
+    poolSize = int( sys.argv[ 2 ] ) if 2 < len( sys.argv ) else 4
+
+    for size in ( 0, poolSize ):
+        res = runWithPoolSize( size, nActors )
+        print( "pool size %(pool)d: mean %(mean).3fs p50 %(p50).3fs p95 %(p95).3fs max %(max).3fs" % res )
@@ -7,10 +7,16 @@ class Pong ( Actor ):
     def init( self, parameters ):
         print( "Called init of actor." )
         self.handle( 'ping', self.ponger )
+        self.handle( 'cached_ping', self.ponger, cacheTtl = 60 )
+        self.handle( 'flush_cache', self.flushCache )
 
     def deinit( self ):
         print( "Called deinit of actor." )
 
     def ponger( self, msg ):
         print( "Received ping: %s" % str( msg ) )
-        return { 'time' : time.time() }
\ No newline at end of file
+        return { 'time' : time.time() }
+
+    def flushCache( self, msg ):
+        self.invalidateCache( 'cached_ping' )
+        return True
@@ -0,0 +1,47 @@
+from beach.actor import Actor
+import gevent
+import gevent.monkey
+import os
+import time
+
+
+class Slow ( Actor ):
+
+    def init( self, parameters ):
+        self.nRunning = 0
+        self.handle( 'wait', self.wait )
+        self.handle( 'capped', self.wait, maxConcurrent = 2 )
+        self.handle( 'hold', self.wait, maxConcurrent = 1 )
+        self.handle( 'metrics', self.metrics )
+        self.handle( 'block', self.block, offload = 'thread' )
+        self.handle( 'crunch', self.crunch, offload = 'process' )
+        self.handle( 'crunch_error', self.crunchError, offload = 'process' )
+        self.handle( 'weighted', self.wait, lane = 'weighted' )
+        self.handle( 'urgent', self.wait, lane = 'urgent' )
+        self.SetConcurrentHandlers( 10 )
+        self.SetLane( 'weighted', weight = 4 )
+        self.SetLane( 'urgent', minHandlers = 1 )
+
+    def wait( self, msg ):
+        self.nRunning += 1
+        running = self.nRunning
+        try:
+            gevent.sleep( msg.get( 'seconds', 0 ) )
+        finally:
+            self.nRunning -= 1
+        return { 'running' : running }
+
+    def metrics( self, msg ):
+        return self.getMetrics()
+
+    def block( self, msg ):
+        # Blocks the whole thread, like a call into a library gevent can't patch
+        gevent.monkey.get_original( 'time', 'sleep' )( msg.get( 'seconds', 0 ) )
+        return { 'blocked' : msg.get( 'seconds', 0 ) }
+
+    def crunch( self, msg ):
+        time.sleep( msg.get( 'seconds', 0 ) )
+        return { 'pid' : os.getpid(), 'ppid' : os.getppid() }
+
+    def crunchError( self, msg ):
+        return 'crunch failed'
@@ -4,7 +4,10 @@ import subprocess
 import signal
 
 from beach.beach_api import Beach
+import gevent
+import zmq.green as zmq
 from beach.utils import *
+from beach.utils import _ZSocket
 
 h_hostmanager = None
 beach = None
@@ -51,6 +54,21 @@ def test_actor_creation():
     assert( 1 == len( d.get( 'realms', {} ).get( 'global', {} ).get( 'pingers', {} ) ) )
     assert( 1 == len( d.get( 'realms', {} ).get( 'global', {} ).get( 'pongers', {} ) ) )
 
+def test_filtered_directory():
+    global beach
+
+    d = beach.getDirectory( realm = 'global', category = 'pingers' )
+    assert( isMessageSuccess( d ) )
+    assert( [ 'global' ] == d.get( 'realms', {} ).keys() )
+    assert( [ 'pingers' ] == d[ 'realms' ][ 'global' ].keys() )
+
+    d = beach.getDirectory( pageSize = 1 )
+    assert( isMessageSuccess( d ) )
+    assert( 1 == len( d.get( 'realms', {} ).get( 'global', {} ).get( 'pingers', {} ) ) )
+    assert( 1 == len( d.get( 'realms', {} ).get( 'global', {} ).get( 'pongers', {} ) ) )
+
+    assert( False is beach.getDirectory( pageSize = 0 ) )
+
 def test_isolated_actor_creation():
     global beach
 
@@ -71,6 +89,240 @@ def test_virtual_handles():
     resp = vHandle.request( 'ping', data = { 'source' : 'outside' }, timeout = 10 )
     assert( resp is not None and resp is not False and 'time' in resp )
 
+def test_bulk_virtual_handles():
+    global beach
+
+    vHandles = beach.getActorHandles( [ 'pingers', 'pongers' ] )
+    assert( 2 == len( vHandles ) )
+    assert( vHandles[ 'pongers' ].isAvailable() )
+    resp = vHandles[ 'pongers' ].request( 'ping', data = { 'source' : 'outside' }, timeout = 10 )
+    assert( resp is not None and resp is not False and 'time' in resp )
+
+    try:
+        beach.getActorHandles()
+        assert( False )
+    except ValueError:
+        pass
+
+def test_request_metadata_not_kept():
+    global beach
+
+    # A timeout used on one request must not stick to later ones
+    vHandle = beach.getActorHandle( 'pongers' )
+    resp = vHandle.request( 'ping', timeout = 1 )
+    assert( resp is not None and resp is not False and 'time' in resp )
+    time.sleep( 1.5 )
+    vHandle2 = beach.getActorHandle( 'pongers' )
+    resp = vHandle2.request( 'ping' )
+    assert( resp is not None and resp is not False and 'time' in resp )
+
+    # Nor does a deadline forwarded along with the data of another request
+    data = { 'source' : 'outside', '_deadline' : time.time() - 1 }
+    resp = vHandle2.request( 'ping', data = data )
+    assert( resp is not None and resp is not False and 'time' in resp )
+    assert( [ '_deadline', 'source' ] == sorted( data.keys() ) )
+
+
+def test_cached_replies():
+    global beach
+
+    vHandle = beach.getActorHandle( 'pongers' )
+    resp = vHandle.request( 'cached_ping', data = { 'source' : 'outside' }, timeout = 10 )
+    assert( resp is not None and resp is not False and 'time' in resp )
+    cached = vHandle.request( 'cached_ping', data = { 'source' : 'outside' }, timeout = 10 )
+    assert( resp[ 'time' ] == cached[ 'time' ] )
+
+    # Other data is another entry
+    other = vHandle.request( 'cached_ping', data = { 'source' : 'elsewhere' }, timeout = 10 )
+    assert( resp[ 'time' ] != other[ 'time' ] )
+
+    assert( isMessageSuccess( vHandle.request( 'flush_cache', timeout = 10 ) ) )
+    fresh = vHandle.request( 'cached_ping', data = { 'source' : 'outside' }, timeout = 10 )
+    assert( resp[ 'time' ] != fresh[ 'time' ] )
+
+
+def test_slow_actor_creation():
+    global beach
+
+    a1 = beach.addActor( 'Slow', 'slowers' )
+    assert( isMessageSuccess( a1 ) )
+
+    time.sleep( 2 )
+
+    d = beach.getDirectory()
+    assert( isMessageSuccess( d ) )
+    assert( 1 == len( d.get( 'realms', {} ).get( 'global', {} ).get( 'slowers', {} ) ) )
+
+def test_concurrency_limit():
+    global beach
+
+    vHandle = beach.getActorHandle( 'slowers' )
+    reqs = [ gevent.spawn( vHandle.request, 'capped', data = { 'seconds' : 0.5 }, timeout = 10 ) for i in range( 6 ) ]
+    gevent.joinall( reqs )
+    assert( all( x.value is not False and 'running' in x.value for x in reqs ) )
+    assert( 2 == max( x.value[ 'running' ] for x in reqs ) )
+
+def test_busy_shedding():
+    global beach
+
+    # The held request keeps the others in their queue, past its 100 slots they are turned away
+    vHandle = beach.getActorHandle( 'slowers' )
+    held = gevent.spawn( vHandle.request, 'hold', data = { 'seconds' : 2 }, timeout = 10 )
+    time.sleep( 0.5 )
+    reqs = [ gevent.spawn( vHandle.request, 'hold', timeout = 10 ) for i in range( 150 ) ]
+    gevent.joinall( reqs + [ held ] )
+    assert( 'running' in held.value )
+    busy = [ x.value for x in reqs if 'running' not in x.value ]
+    assert( 0 != len( busy ) and len( busy ) < 150 )
+    assert( all( 'busy' == x[ 'status' ][ 'error' ] and 0 < x[ 'data' ][ 'retry_after' ] for x in busy ) )
+
+def test_deadline_drop():
+    global beach
+
+    d = beach.getDirectory()
+    endpoint = d[ 'realms' ][ 'global' ][ 'slowers' ].values()[ 0 ]
+    vHandle = beach.getActorHandle( 'slowers' )
+    held = gevent.spawn( vHandle.request, 'hold', data = { 'seconds' : 1 }, timeout = 10 )
+    time.sleep( 0.2 )
+
+    # Still queued behind the held request when its deadline passes
+    z = _ZSocket( zmq.REQ, endpoint )
+    resp = z.request( { 'req' : 'hold', '_deadline' : time.time() + 0.2 }, timeout = 10 )
+    z.close()
+    gevent.joinall( [ held ] )
+    assert( 'deadline expired' == resp[ 'status' ][ 'error' ] )
+    metrics = vHandle.request( 'metrics', timeout = 10 )
+    assert( 1 <= metrics[ 'expired' ] )
+
+def test_cancel():
+    global beach
+
+    vHandle = beach.getActorHandle( 'slowers' )
+    before = vHandle.request( 'metrics', timeout = 10 )[ 'cancelled' ]
+    assert( False is vHandle.request( 'wait', data = { 'seconds' : 5 }, timeout = 0.5 ) )
+    time.sleep( 0.5 )
+    metrics = vHandle.request( 'metrics', timeout = 10 )
+    assert( before + 1 == metrics[ 'cancelled' ] )
+    # The cancelled handler was interrupted, only the metrics request is running
+    assert( 1 == metrics[ 'busy' ] )
+
+
+def test_malformed_metadata():
+    global beach
+
+    d = beach.getDirectory()
+    endpoint = d[ 'realms' ][ 'global' ][ 'pongers' ].values()[ 0 ]
+    z = _ZSocket( zmq.REQ, endpoint )
+    resp = z.request( { 'req' : 'ping', '_rid' : [ 1 ], '_deadline' : 'soon' }, timeout = 10 )
+    assert( resp is not False and 'time' in resp )
+    resp = z.request( { 'req' : '__cancel', '_rid' : { 'a' : 1 } }, timeout = 10 )
+    assert( resp is not False and not isMessageSuccess( resp ) )
+    z.close()
+
+    # The actor still serves requests
+    vHandle = beach.getActorHandle( 'pongers' )
+    resp = vHandle.request( 'ping', timeout = 10 )
+    assert( resp is not None and resp is not False and 'time' in resp )
+
+
+def test_lanes():
+    global beach
+
+    vHandle = beach.getActorHandle( 'slowers' )
+
+    def timedRequest( requestType, seconds ):
+        start = time.time()
+        resp = vHandle.request( requestType, data = { 'seconds' : seconds }, timeout = 20 )
+        assert( resp is not False and 'running' in resp )
+        return time.time() - start
+
+    # The shared handlers are all busy, the queued requests of the weighted
+    # lane get most of them as they free up
+    busy = [ gevent.spawn( timedRequest, 'wait', 1 ) for i in range( 10 ) ]
+    time.sleep( 0.2 )
+    normal = [ gevent.spawn( timedRequest, 'wait', 0.2 ) for i in range( 20 ) ]
+    weighted = [ gevent.spawn( timedRequest, 'weighted', 0.2 ) for i in range( 20 ) ]
+    time.sleep( 0.2 )
+
+    # The lane with a handler of its own does not wait on the others
+    assert( timedRequest( 'urgent', 0 ) < 0.5 )
+
+    gevent.joinall( busy + normal + weighted )
+    assert( all( x.successful() for x in busy + normal + weighted ) )
+    assert( sum( x.value for x in weighted ) < sum( x.value for x in normal ) )
+
+def test_thread_offload():
+    global beach
+
+    vHandle = beach.getActorHandle( 'slowers' )
+    blocked = gevent.spawn( vHandle.request, 'block', data = { 'seconds' : 2 }, timeout = 10 )
+    time.sleep( 0.5 )
+
+    # The actor keeps serving while the blocking handler runs in its thread
+    start = time.time()
+    resp = vHandle.request( 'wait', timeout = 10 )
+    assert( resp is not False and 'running' in resp )
+    assert( time.time() - start < 1 )
+
+    blocked.join()
+    assert( blocked.value is not False and 2 == blocked.value[ 'blocked' ] )
+
+def test_process_offload():
+    global beach
+
+    vHandle = beach.getActorHandle( 'slowers' )
+    reqs = [ gevent.spawn( vHandle.request, 'crunch', data = { 'seconds' : 1 }, timeout = 10 ) for i in range( 4 ) ]
+    gevent.joinall( reqs )
+    assert( all( x.value is not False and 'pid' in x.value for x in reqs ) )
+    assert( all( x.value[ 'pid' ] != x.value[ 'ppid' ] for x in reqs ) )
+    pids = set( x.value[ 'pid' ] for x in reqs )
+    assert( 2 == len( pids ) )
+
+    endpoint = beach.getDirectory()[ 'realms' ][ 'global' ][ 'slowers' ].values()[ 0 ]
+    z = _ZSocket( zmq.REQ, endpoint )
+    resp = z.request( { 'req' : 'crunch_error' }, timeout = 10 )
+    assert( resp is not False and 'crunch failed' == resp[ 'status' ][ 'error' ] )
+
+    # The workers survived the error reply
+    resp = z.request( { 'req' : 'crunch' }, timeout = 10 )
+    assert( resp is not False and resp.get( 'pid' ) in pids )
+    z.close()
+
+    # All the workers exit promptly with the actor
+    assert( beach.stopActors( withCategory = 'slowers' ) )
+    time.sleep( 1 )
+    for pid in pids:
+        try:
+            os.kill( pid, 0 )
+        except OSError:
+            continue
+        assert( False )
+
+
+def test_bulk_actor_creation():
+    global beach
+
+    actors = beach.addActors( 'Pong', 'bulkpongers', 3 )
+    assert( 3 == len( actors ) )
+    assert( all( isMessageSuccess( x ) for x in actors ) )
+
+    time.sleep( 2 )
+
+    d = beach.getDirectory()
+    assert( isMessageSuccess( d ) )
+    assert( 3 == len( d.get( 'realms', {} ).get( 'global', {} ).get( 'bulkpongers', {} ) ) )
+    assert( set( x[ 'uid' ] for x in actors ) == set( d[ 'realms' ][ 'global' ][ 'bulkpongers' ].keys() ) )
+
+
+def test_stopping_actors():
+    global beach
+
+    assert( beach.stopActors( withCategory = 'bulkpongers' ) )
+
+    d = beach.getDirectory()
+    assert( isMessageSuccess( d ) )
+    assert( 0 == len( d.get( 'realms', {} ).get( 'global', {} ).get( 'bulkpongers', {} ) ) )
+
 
 def test_flushing_single_node_cluster():
     f = beach.flush()